@@ -10,6 +10,9 @@ from pathlib import Path
 import sqlite3
 from sqlite3 import Error
 
+# the 1D peak lists that are kept, by Spectral_dim atom type, and the nucleus recorded for their spectra
+NUCLEI = {'H': '1H', 'C': '13C'}
+
 
 class BMRB_Reader:
     """
@@ -39,6 +42,7 @@ class BMRB_Reader:
                                    'solvent': []},
                        'spectra': {'spectrum_id': [],
                                    'sample_id': [],
+                                   'nucleus': [],
                                    'frequency': []},
                        'multiplets': {'multiplet_id': [],
                                       'spectrum_id': [],
@@ -51,6 +55,10 @@ class BMRB_Reader:
                                  'shift': [],
                                  'intensity': [],
                                  'width': []},
+                       'peaks_2d': {'peak_id': [],
+                                    'spectrum_id': [],
+                                    'shift_1': [],
+                                    'shift_2': []},
                        'synonyms': {'metabolite_id': [],
                                     'synonym': []},
                        'isin': {'metabolite_id': [],
@@ -103,6 +111,8 @@ class BMRB_Reader:
         spectra.to_sql('spectra', self.conn, if_exists='replace', index=False)
         peaks = pd.DataFrame(self.tables['peaks'])
         peaks.to_sql('peaks', self.conn, if_exists='replace', index=False)
+        peaks = pd.DataFrame(self.tables['peaks_2d'])
+        peaks.to_sql('peaks_2d', self.conn, if_exists='replace', index=False)
         peaks = pd.DataFrame(self.tables['multiplets'])
         peaks.to_sql('multiplets', self.conn, if_exists='replace', index=False)
         peaks = pd.DataFrame(self.tables['synonyms'])
@@ -143,24 +153,48 @@ class BMRB_Reader:
             # find the dimension details for all spectral peak lists
             dimension_tables = self.get_loop_tables(entry, 'Spectral_dim')
 
-            # only use the peak lists that are 1D 1H
+            # only use the peak lists that are 1D 1H or 13C, noting the nucleus of each
             peaklist_ids = []
+            nuclei = {}
             for table in [table for table in dimension_tables if
-                          len(table) == 1 and table.loc[0, 'Atom_type'] == 'H']:
-                peaklist_id = table.loc[table['Atom_type'] == 'H', 'Spectral_peak_list_ID'].iloc[0]
+                          len(table) == 1 and table.loc[0, 'Atom_type'] in NUCLEI]:
+                peaklist_id = table.loc[0, 'Spectral_peak_list_ID']
                 peaklist_ids.append(peaklist_id)
+                nuclei[peaklist_id] = NUCLEI[table.loc[0, 'Atom_type']]
+
+            # and the 2D peak lists, with their dimensions put in the order of NUCLEI so 1H comes before 13C
+            # and a spectrum's nucleus reads like 1H-13C
+            peaklist_ids_2d = []
+            dimensions = {}
+            atom_types = list(NUCLEI)
+            for table in [table for table in dimension_tables if
+                          len(table) == 2 and all(table['Atom_type'].isin(atom_types))]:
+                peaklist_id = table.loc[0, 'Spectral_peak_list_ID']
+                peaklist_ids_2d.append(peaklist_id)
+                ordered = sorted(zip(table['Atom_type'], table['ID']), key=lambda dim: (atom_types.index(dim[0]), dim[1]))
+                dimensions[peaklist_id] = [dim_id for atom_type, dim_id in ordered]
+                nuclei[peaklist_id] = '-'.join(NUCLEI[atom_type] for atom_type, dim_id in ordered)
 
             # acquire chemical shift and intensity tables first as we dont want entries with incomplete peak data
             chem_shift_tables = [table for table in self.get_loop_tables(entry, 'Spectral_transition_char') if
                                  table.loc[0, 'Spectral_peak_list_ID'] in peaklist_ids]
-            if len(chem_shift_tables) < 1:
+            chem_shift_tables_2d = [table for table in self.get_loop_tables(entry, 'Spectral_transition_char') if
+                                    table.loc[0, 'Spectral_peak_list_ID'] in peaklist_ids_2d]
+            if len(chem_shift_tables) < 1 and len(chem_shift_tables_2d) < 1:
                 print(f'insufficient chemical shift data in file {file}')
                 fail_counts['chem_shift'] += 1
                 fail_counts['total'] += 1
                 continue
-            intensity_tables = [table for table in self.get_loop_tables(entry, 'Spectral_transition_general_char') if
-                                table.loc[0, 'Spectral_peak_list_ID'] in peaklist_ids]
-            if len(intensity_tables) < 1:
+            # intensity tables by the peak list they belong to, a 1D peak list without one is skipped on its own
+            intensity_tables = {table.loc[0, 'Spectral_peak_list_ID']: table for table in
+                                self.get_loop_tables(entry, 'Spectral_transition_general_char') if
+                                table.loc[0, 'Spectral_peak_list_ID'] in peaklist_ids}
+            for table in chem_shift_tables:
+                if table.loc[0, 'Spectral_peak_list_ID'] not in intensity_tables:
+                    print(f'insufficient peak intensity data for peak list {table.loc[0, "Spectral_peak_list_ID"]} in file {file}')
+            chem_shift_tables = [table for table in chem_shift_tables if
+                                 table.loc[0, 'Spectral_peak_list_ID'] in intensity_tables]
+            if len(chem_shift_tables) < 1 and len(chem_shift_tables_2d) < 1:
                 print(f'insufficient peak intensity data in file {file}')
                 fail_counts['intensity'] += 1
                 fail_counts['total'] += 1
@@ -208,7 +242,7 @@ class BMRB_Reader:
 
             tagtables = self.get_saveframe_tags(entry, 'spectral_peak_list')
             links = {}
-            for tagtable in [tagtable for tagtable in tagtables if tagtable.loc[tagtable['tag'] == 'ID', 'value'].iloc[0] in peaklist_ids]:
+            for tagtable in [tagtable for tagtable in tagtables if tagtable.loc[tagtable['tag'] == 'ID', 'value'].iloc[0] in peaklist_ids + peaklist_ids_2d]:
                 peaklist_id_linkname = tagtable.loc[tagtable['tag'] == 'ID', 'value'].iloc[0]
                 experiment_id = tagtable.loc[tagtable['tag'] == 'Experiment_ID', 'value'].iloc[0]
                 sample_id = tagtable.loc[tagtable['tag'] == 'Sample_ID', 'value'].iloc[0]
@@ -256,7 +290,7 @@ class BMRB_Reader:
                     except:
                         temperature = None
                 for index, row in experiment_tables[0].iterrows():
-                    spectrum_added = False
+                    nucleus = None
                     spectrum_id = f'SP:{spectrum_count}'
                     experiment_id = row['ID']
                     spectrometer_id = row['NMR_spectrometer_ID']
@@ -266,7 +300,7 @@ class BMRB_Reader:
                             frequency = spectrometer_tags_table.loc[spectrometer_tags_table['tag'] == 'Field_strength', 'value'].iloc[0]
 
                     # obtain chemical shift and intensity data from BMRB (filtered by experiment type)
-                    for table_num, table in enumerate(chem_shift_tables):
+                    for table in chem_shift_tables:
                         peaklist_id = table.loc[0, 'Spectral_peak_list_ID']
                         if links[peaklist_id]['experiment_id'] == experiment_id and links[peaklist_id]['sample_id'] == bmrb_sample_id:
                             # get the peak data
@@ -277,7 +311,7 @@ class BMRB_Reader:
                                 self.tables['peaks']['multiplet_id'].append(f'MT:{spectrum_count}.{index+1}')
                                 peak_shift = row['Chem_shift_val']
                                 self.tables['peaks']['shift'].append(peak_shift)
-                                peak_intensity = intensity_tables[table_num].loc[index, 'Intensity_val']
+                                peak_intensity = intensity_tables[peaklist_id].loc[index, 'Intensity_val']
                                 self.tables['peaks']['intensity'].append(peak_intensity)
                                 self.tables['peaks']['width'].append(0.004)
 
@@ -286,23 +320,42 @@ class BMRB_Reader:
                                 self.tables['multiplets']['center'].append(peak_shift)
                                 self.tables['multiplets']['atom_ref'].append(None)
                                 self.tables['multiplets']['multiplicity'].append('Unknown')
-                            if sample_added is False:
-                                self.tables['samples']['sample_id'].append(sample_id)
-                                self.tables['samples']['metabolite_id'].append(metabolite_id)
-                                self.tables['samples']['pH'].append(ph)
-                                self.tables['samples']['temperature'].append(temperature)
-                                self.tables['samples']['amount'].append(amount)
-                                self.tables['samples']['units'].append(units)
-                                self.tables['samples']['reference'].append(reference)
-                                self.tables['samples']['solvent'].append(solvent)
-                                sample_count += 1
-                                sample_added = True
-                            if spectrum_added is False:
-                                self.tables['spectra']['spectrum_id'].append(spectrum_id)
-                                self.tables['spectra']['sample_id'].append(sample_id)
-                                self.tables['spectra']['frequency'].append(frequency)
-                                spectrum_count += 1
-                                spectrum_added = True
+                            nucleus = nuclei[peaklist_id]
+
+                    # obtain the cross peaks of 2D peak lists, each transition has a shift in both dimensions
+                    for table in chem_shift_tables_2d:
+                        peaklist_id = table.loc[0, 'Spectral_peak_list_ID']
+                        if links[peaklist_id]['experiment_id'] == experiment_id and links[peaklist_id]['sample_id'] == bmrb_sample_id:
+                            first, second = dimensions[peaklist_id]
+                            peak_count = 1
+                            for transition_id, transition in table.groupby('Spectral_transition_ID', sort=False):
+                                shifts = dict(zip(transition['Spectral_dim_ID'], transition['Chem_shift_val']))
+                                if first not in shifts or second not in shifts:
+                                    continue
+                                self.tables['peaks_2d']['peak_id'].append(f'PK2:{spectrum_count}.{peak_count}')
+                                self.tables['peaks_2d']['spectrum_id'].append(spectrum_id)
+                                self.tables['peaks_2d']['shift_1'].append(shifts[first])
+                                self.tables['peaks_2d']['shift_2'].append(shifts[second])
+                                peak_count += 1
+                            nucleus = nuclei[peaklist_id]
+
+                    if nucleus is not None:
+                        if sample_added is False:
+                            self.tables['samples']['sample_id'].append(sample_id)
+                            self.tables['samples']['metabolite_id'].append(metabolite_id)
+                            self.tables['samples']['pH'].append(ph)
+                            self.tables['samples']['temperature'].append(temperature)
+                            self.tables['samples']['amount'].append(amount)
+                            self.tables['samples']['units'].append(units)
+                            self.tables['samples']['reference'].append(reference)
+                            self.tables['samples']['solvent'].append(solvent)
+                            sample_count += 1
+                            sample_added = True
+                        self.tables['spectra']['spectrum_id'].append(spectrum_id)
+                        self.tables['spectra']['sample_id'].append(sample_id)
+                        self.tables['spectra']['nucleus'].append(nucleus)
+                        self.tables['spectra']['frequency'].append(frequency)
+                        spectrum_count += 1
 
             # populate the synonyms table
             synonym_tables = self.get_loop_tables(entry, 'Chem_comp_common_name')
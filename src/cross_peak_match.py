@@ -0,0 +1,127 @@
+"""
+Matching of 2D cross peaks, such as the (1H, 13C) peaks of an HSQC, against the 2D peak lists kept by
+bmrb_pynmrstar_reader.BMRB_Reader in its peaks_2d table.
+Every library cross peak is a point scaled by the per dimension tolerances and held in one KD-tree, so each
+query cross peak only looks at the library peaks within its tolerance ellipse.
+"""
+
+import pathlib
+import sqlite3
+import sys
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from match import Hit, FETCH_SIZE, format_hits, smallest
+
+# the bmrb database holding the 2D peak lists
+DATABASE = 'ccpn_metabolites_bmrb.db'
+# default matching tolerance in ppm of each dimension, a query peak further out than this is unmatched
+TOLERANCES = {'1H-13C': (0.03, 0.3),
+              '1H-1H': (0.03, 0.03)}
+
+
+def stream_cross_peaks(path, nucleus='1H-13C'):
+    """
+    Streams the 2D cross peaks of one nucleus pair from a database built by BMRB_Reader,
+    fetched FETCH_SIZE rows at a time.
+    Yields (id, spectrum_id, name, shift_1, shift_2) rows.
+    """
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        sql = ''' select cast(metabolites.accession as text), peaks_2d.spectrum_id, coalesce(metabolites.name, ''),
+                         cast(peaks_2d.shift_1 as real), cast(peaks_2d.shift_2 as real)
+                  from peaks_2d
+                  join spectra on spectra.spectrum_id = peaks_2d.spectrum_id
+                  join samples on samples.sample_id = spectra.sample_id
+                  join metabolites on metabolites.metabolite_id = samples.metabolite_id
+                  where spectra.nucleus = ? and peaks_2d.shift_1 is not null and peaks_2d.shift_2 is not null '''
+        cursor = conn.execute(sql, (nucleus,))
+        rows = cursor.fetchmany(FETCH_SIZE)
+        while rows:
+            yield from rows
+            rows = cursor.fetchmany(FETCH_SIZE)
+    finally:
+        conn.close()
+
+
+class CrossPeakMatch:
+    """
+    Holds the 2D peak lists of one nucleus pair in a KD-tree and scores library spectra against query cross peaks.
+    Distances are measured in tolerances, so a query peak at distance d from its nearest cross peak in a spectrum
+    adds min(d, 1) to that spectrum's score and an unmatched query peak adds 1. Lower scores are better.
+    """
+    def __init__(self, nucleus='1H-13C', tolerances=None):
+        self.nucleus = nucleus
+        self.tolerances = np.asarray(tolerances if tolerances is not None else TOLERANCES[nucleus], dtype=float)
+        self.keys = []
+        self.names = {}
+        self.peaks = np.empty((0, 2))
+        self.owners = np.empty(0, dtype=np.int64)
+        self.tree = cKDTree(self.peaks)
+
+    def load_database(self, path):
+        """
+        Loads the cross peaks of every spectrum of this nucleus pair and builds the tree.
+        """
+        spectra = {}
+        owners, peaks = [], []
+        for id, spectrum_id, name, shift_1, shift_2 in stream_cross_peaks(path, self.nucleus):
+            key = (id, spectrum_id)
+            if key not in spectra:
+                spectra[key] = len(self.keys)
+                self.keys.append(key)
+                self.names[id] = name
+            owners.append(spectra[key])
+            peaks.append((shift_1, shift_2))
+        self.build(np.array(owners, dtype=np.int64), np.array(peaks, dtype=float).reshape(-1, 2))
+
+    def load(self, cwd='/home/mh491/Database'):
+        self.load_database(pathlib.Path(cwd, DATABASE))
+
+    def build(self, owners, peaks):
+        self.owners = owners
+        self.peaks = peaks
+        self.tree = cKDTree(peaks / self.tolerances)
+
+    def score(self, cross_peaks):
+        """
+        Scores the library spectra against the query cross peaks, given as (shift_1, shift_2) pairs.
+        Returns the spectra that match at least one query peak and their scores.
+        """
+        queries = np.asarray(cross_peaks, dtype=float).reshape(-1, 2)
+        if len(queries) == 0 or len(self.peaks) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        found = self.tree.query_ball_point(queries / self.tolerances, r=1.0)
+        counts = np.array([len(peaks) for peaks in found], dtype=np.int64)
+        if counts.sum() == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        peaks = np.concatenate([np.asarray(peaks, dtype=np.int64) for peaks in found])
+        query_peaks = np.repeat(np.arange(len(queries)), counts)
+        distances = np.hypot(*((self.peaks[peaks] - queries[query_peaks]) / self.tolerances).T)
+
+        # the nearest cross peak of each spectrum to each query peak, every other pair counts as unmatched
+        spectra, owners = np.unique(self.owners[peaks], return_inverse=True)
+        nearest = np.ones((len(spectra), len(queries)))
+        np.minimum.at(nearest, (owners, query_peaks), distances)
+        return spectra, nearest.sum(axis=1)
+
+    def top_k(self, cross_peaks, k=10):
+        """
+        Finds the k library spectra that best match the query cross peaks.
+        Returns a list of Hit tuples, best first.
+        """
+        spectra, scores = self.score(cross_peaks)
+        hits = []
+        for score, spectrum in smallest(scores, spectra, k):
+            id = self.keys[spectrum][0]
+            hits.append(Hit(score, id, self.names.get(id, '').strip(' "')))
+        return hits
+
+
+if __name__ == '__main__':
+    # cross peaks are given as pairs of shifts, 1H then 13C
+    shifts = [float(arg) for arg in sys.argv[1:]]
+    match = CrossPeakMatch()
+    match.load()
+    print(format_hits(match.top_k(list(zip(shifts[0::2], shifts[1::2])))))
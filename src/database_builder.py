@@ -8,6 +8,23 @@ import sqlite3
 from sqlite3 import Error
 import re
 import decimal
+import resource
+import io
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import hmdb_xml
+
+# metabolites parsed between each flush of the Builder's tables to the db file
+BUILDER_BATCH_SIZE = 1000
+# the tables written by the Builder, in the order they are flushed
+BUILDER_TABLES = ['metabolites', 'synonyms', 'isin', 'ontology', 'ontology_closure', 'concentrations']
+# indexes made on the Builder's tables once they are written, as (name, table, columns)
+BUILDER_INDEXES = [('isin_term', 'isin', 'term_id'),
+                   ('isin_metabolite', 'isin', 'metabolite_id'),
+                   ('ontology_term', 'ontology', 'term_id'),
+                   ('ontology_group', 'ontology', '"group"'),
+                   ('ontology_closure_ancestor', 'ontology_closure', 'ancestor_id, term_id')]
 
 
 class Builder:
@@ -17,7 +34,8 @@ class Builder:
     accession number.
     Builds the metabolite table by adding columns whenever a new variable is found, thus it defines its own shape.
     A few exceptions are given for known tags that should not be accepted.
-    Has a limit of 1430 iterations as local memory gets used up too fast for little reward beyond this.
+    The xml file is streamed, each metabolite element is released once built and the tables are flushed to the db
+    file every BUILDER_BATCH_SIZE metabolites, so memory stays flat over the whole file.
     Only needs to be called once, beyond which it is commented out of the main method when experimenting with the
     reader.
     """
@@ -38,11 +56,12 @@ class Builder:
                            '{http://www.hmdb.ca}general_references',
                            '{http://www.hmdb.ca}protein_associations']
         self.names = pd.read_csv('/home/mh491/Database/HMDB_files/metabolite_names.csv', index_col=0)
-        self.metabolites = None
-        self.synonyms = None
-        self.isin = None
-        self.ontology = None
-        self.concentrations = None
+        # rows waiting to be flushed to each table, as dictionaries of column name to value
+        self.tables = {table: [] for table in BUILDER_TABLES}
+        # integer id of each ontology term already added, and the ids of its ancestors and descendants, across flushes
+        self.terms = {}
+        self.ancestors = {}
+        self.descendants = {}
 
     def create_connection(self):
         """
@@ -67,35 +86,22 @@ class Builder:
             metabolite_id = f'SU:{count}'
             titles = self.metabolite_titles(elem)
             data = self.metabolite_data(metabolite_id, elem)
-            data = pd.DataFrame([data], columns=titles, index=[metabolite_id])
-            self.insert_into_table(data)
+            self.insert_into_table(dict(zip(titles, data)))
 
             """Gather the synonyms for this metabolite"""
             synonyms = self.get_synonyms(elem)
             for syn in synonyms:
-                data = pd.DataFrame([[metabolite_id, syn]], columns=['metabolite_id', 'synonym'])
-                if self.synonyms is None:
-                    self.synonyms = data
-                else:
-                    self.synonyms = self.synonyms.append(data)
+                self.tables['synonyms'].append({'metabolite_id': metabolite_id, 'synonym': syn})
 
             """Gather ontology data for this metabolite"""
-            ont = elem.find('{http://www.hmdb.ca}ontology')
-            tag = '{http://www.hmdb.ca}term'
-            self.retrieve_all(metabolite_id, ont, tag)
+            self.retrieve_all(metabolite_id, elem)
 
             """Gather concentration data for this metabolite"""
-            if elem.find('{http://www.hmdb.ca}normal_concentrations') is not None:
-                concelem = elem.find('{http://www.hmdb.ca}normal_concentrations')
-                for concentration in concelem.getchildren():
-                    self.get_concentrations(concentration, metabolite_id)
-            if elem.find('{http://www.hmdb.ca}abnormal_concentrations') is not None:
-                concelem = elem.find('{http://www.hmdb.ca}abnormal_concentrations')
-                for concentration in concelem.getchildren():
-                    self.get_concentrations(concentration, metabolite_id)
+            for concentration in hmdb_xml.concentrations(elem):
+                self.get_concentrations(concentration, metabolite_id)
 
             """Updates the id number and prints a report to the console"""
-            print(f'parsed {count} metabolites out of 1430')
+            print(f'parsed {count} metabolites')
             count += 1
         return count
 
@@ -107,8 +113,8 @@ class Builder:
         name = elem.tag.split('}', 1)[1]
         titles = ['metabolite_id']
         # titles = [f'{name}_id']
-        for child in elem.getchildren():
-            if len(child.getchildren()) == 0 and child.tag not in self.exceptions:
+        for child in hmdb_xml.leaves(elem):
+            if child.tag not in self.exceptions:
                 name = child.tag.split('}', 1)[1]
                 titles.append(name)
         if parent is not None:
@@ -121,101 +127,254 @@ class Builder:
         Used for the bottom level metabolite metadata
         """
         data = [metabolite_id]
-        for child in elem.getchildren():
-            if len(child.getchildren()) == 0 and child.tag not in self.exceptions:
+        for child in hmdb_xml.leaves(elem):
+            if child.tag not in self.exceptions:
                 data.append(child.text)
         return data
 
     def insert_into_table(self, data):
         """
-        A method for creating or appending data to the metabolite dataframe
+        A method for adding a row to the metabolite table buffer
         """
-        if self.metabolites is None:
-            self.metabolites = data
-        else:
-            self.metabolites = self.metabolites.append(data)
+        self.tables['metabolites'].append(data)
 
     def get_synonyms(self, elem):
         """
-        A method for gathering synonym data from a synonym element
+        A method for gathering synonym data from a metabolite element
         """
-        syn = elem.find('{http://www.hmdb.ca}synonyms')
-        synonyms = []
-        if len(syn.getchildren()) > 0:
-            for child in syn.getchildren():
-                synonyms.append(child.text)
-        return synonyms
+        return hmdb_xml.synonyms(elem)
 
-    def retrieve_all(self, metab_id, elem, tag=None, parent=None):
+    def retrieve_all(self, metab_id, elem):
         """
         A method for gathering ontology data
-        Recursively scans the ontology element for nodes under the 'term' tag
-        Adds values to the ontology dataframe if they are not already present
-        Adds values to the isin dataframe
-        """
-        if len(elem.getchildren()) > 0:
-            for child in elem.getchildren():
-                self.retrieve_all(metab_id, child, tag, elem)
-        elif elem.tag == tag:
-            titles = ['group', 'definition']
-            data = pd.DataFrame([[elem.text, parent.find('{http://www.hmdb.ca}definition').text]], columns=titles)
-            linktitles = ['metabolite_id', 'group']
-            link = pd.DataFrame([[metab_id, elem.text]], columns=linktitles)
-            if self.isin is None:
-                self.isin = link
-            else:
-                self.isin = self.isin.append(link)
-            if self.ontology is None:
-                self.ontology = data
-            elif elem.text not in self.ontology.index:
-                self.ontology = self.ontology.append(data)
+        Takes every 'term' leaf of the metabolite's ontology along with its definition and the term above it
+        Adds them to the isin table buffer as they are, intern_terms turns them into term ids before each flush
+        """
+        for term, definition, parent in hmdb_xml.ontology_terms(elem):
+            self.tables['isin'].append({'metabolite_id': metab_id, 'group': term, 'definition': definition,
+                                        'parent': parent})
+
+    def intern_terms(self):
+        """
+        A method for normalising the ontology data gathered by retrieve_all
+        Gives each term an integer id the first time it is seen and adds it to the ontology table
+        Keeps the ontology_closure table holding an (ancestor, term) row for every term below another, and each term
+        itself, so the metabolites under a term are found with one indexed join
+        Replaces the buffered isin rows with one (metabolite, term id) row per metabolite and term
+        """
+        isin = []
+        found = set()
+        for row in self.tables['isin']:
+            parent_id = self.intern(row['parent']) if row['parent'] is not None else None
+            term_id = self.intern(row['group'], row['definition'], parent_id)
+            if parent_id is not None:
+                self.link(parent_id, term_id)
+            if (row['metabolite_id'], term_id) not in found:
+                found.add((row['metabolite_id'], term_id))
+                isin.append({'metabolite_id': row['metabolite_id'], 'term_id': term_id})
+        self.tables['isin'] = isin
+
+    def intern(self, term, definition=None, parent_id=None):
+        """
+        Returns the id of an ontology term, adding it to the ontology table if it is new
+        """
+        term_id = self.terms.get(term)
+        if term_id is None:
+            term_id = len(self.terms) + 1
+            self.terms[term] = term_id
+            self.ancestors[term_id] = {term_id}
+            self.descendants[term_id] = {term_id}
+            self.tables['ontology'].append({'term_id': term_id, 'group': term, 'definition': definition,
+                                            'parent_id': parent_id})
+            self.tables['ontology_closure'].append({'ancestor_id': term_id, 'term_id': term_id})
+        return term_id
+
+    def link(self, parent_id, term_id):
+        """
+        Records that a term sits below a parent term, adding the closure rows this gives the term and everything
+        below it. A term can be found under more than one parent, so links are added whenever they are new
+        """
+        added = self.ancestors[parent_id] - self.ancestors[term_id]
+        for descendant in list(self.descendants[term_id]):
+            for ancestor in added - self.ancestors[descendant]:
+                self.ancestors[descendant].add(ancestor)
+                self.descendants[ancestor].add(descendant)
+                self.tables['ontology_closure'].append({'ancestor_id': ancestor, 'term_id': descendant})
+
+    def metabolites_under(self, term):
+        """
+        Returns the ids of the metabolites in an ontology term or any term below it, read from the db file
+        """
+        sql = ''' select distinct isin.metabolite_id
+                  from ontology
+                  join ontology_closure on ontology_closure.ancestor_id = ontology.term_id
+                  join isin on isin.term_id = ontology_closure.term_id
+                  where ontology."group" = ? '''
+        return [row[0] for row in self.conn.execute(sql, (term,))]
 
     def get_concentrations(self, concelem, metabolite_id):
         """
         A method for gathering concentration data
         Used for both normal and abnormal concentration data
-        Does not add values to the concentration dataframe but returns a dataframe
+        Adds a row to the concentration table buffer
         """
-        titles = ['metabolite_id']
-        data = [metabolite_id]
-        for child in concelem.getchildren():
-            if len(child.getchildren()) == 0:
-                titles.append(child.tag.split('}', 1)[1])
-                data.append(child.text)
-        concs = pd.DataFrame([data], columns=titles)
-        if self.concentrations is None:
-            self.concentrations = concs
-        else:
-            self.concentrations = self.concentrations.append(concs)
+        data = {'metabolite_id': metabolite_id}
+        for child in hmdb_xml.leaves(concelem):
+            data[child.tag.split('}', 1)[1]] = child.text
+        self.tables['concentrations'].append(data)
 
     def save_to_db(self):
         """
-        Saves all dataframes to the db file
-        This method is called once from outside the class
+        Turns the buffered rows of each table into a dataframe, appends it to the db file and empties the buffer
+        Called every BUILDER_BATCH_SIZE metabolites and once at the end by parse_metabolites
+        """
+        self.intern_terms()
+        for table in BUILDER_TABLES:
+            if len(self.tables[table]) == 0:
+                continue
+            data = pd.DataFrame(self.tables[table])
+            if 'parent_id' in data.columns:
+                # root terms have no parent, which would otherwise make the ids floats
+                data['parent_id'] = data['parent_id'].astype('Int64')
+            self.add_columns(table, data.columns)
+            data.to_sql(table, self.conn, if_exists='append', index=False)
+            self.tables[table] = []
+        self.conn.commit()
+
+    def add_columns(self, table, columns):
+        """
+        Adds any columns a batch has that its table in the db file does not, as the metabolite table takes its shape
+        from the tags found
+        """
+        existing = [row[1] for row in self.conn.execute(f'pragma table_info("{table}")')]
+        if len(existing) == 0:
+            return
+        for column in columns:
+            if column not in existing:
+                self.conn.execute(f'alter table "{table}" add column "{column}"')
+
+    def clear_tables(self):
+        """
+        Drops the tables of an earlier run, so the batches of this run are not appended to them
         """
-        self.metabolites.to_sql('metabolites', self.conn, if_exists='replace', index=False)
-        self.synonyms.to_sql('synonyms', self.conn, if_exists='replace', index=False)
-        self.isin.to_sql('isin', self.conn, if_exists='replace', index=False)
-        self.ontology.to_sql('ontology', self.conn, if_exists='replace', index=False)
-        self.concentrations.to_sql('concentrations', self.conn, if_exists='replace', index=False)
+        for table in BUILDER_TABLES:
+            self.conn.execute(f'drop table if exists "{table}"')
+        self.conn.commit()
+        self.terms = {}
+        self.ancestors = {}
+        self.descendants = {}
+
+    def create_indexes(self):
+        """
+        Indexes the written tables, see BUILDER_INDEXES, once every batch has been flushed
+        """
+        for name, table, columns in BUILDER_INDEXES:
+            self.conn.execute(f'create index if not exists {name} on "{table}" ({columns})')
+        self.conn.commit()
 
     def parse_metabolites(self):
         """
-        A method that parses through the single xml file and builds element trees for each metabolite
-        Calls the builder 'build' method to create a data entry for each metabolite
-        Contains a fixed count of 1430 metabolites as any parsing beyond this value results in sigkill
+        A method that streams through the single xml file and builds element trees for each metabolite
+        Calls the builder 'build' method to create a data entry for each metabolite, see hmdb_xml.iter_metabolites
+        for how parsed metabolites are released, using lxml when it is installed
+        Flushes the tables to the db file every BUILDER_BATCH_SIZE metabolites and reports the peak memory used
         """
         file = self.directory.joinpath('HMDB_files/hmdb_metabolites.xml')
-        nsmap = {}
+        self.clear_tables()
+        count = 1
+        parsed = 0
+        for elem in hmdb_xml.iter_metabolites(file):
+            count = self.build(count, elem)
+            parsed += 1
+            if parsed % BUILDER_BATCH_SIZE == 0:
+                self.save_to_db()
+                print(f'flushed {parsed} metabolites, peak rss {self.peak_rss():.1f} MB')
+        self.save_to_db()
+        self.create_indexes()
+        print(f'parsed {parsed} metabolites, kept {count - 1}, peak rss {self.peak_rss():.1f} MB')
+
+    def parse_parallel(self, workers=os.cpu_count()):
+        """
+        A parallel version of parse_metabolites
+        Splits the xml file into ranges of BUILDER_BATCH_SIZE metabolites at their start tags, see
+        hmdb_xml.metabolite_ranges, and builds the rows of each range in a worker process with parse_range
+        The ranges are merged in file order, so the SU ids and the tables written match parse_metabolites
+        At most two ranges per worker are in flight, so memory stays bounded
+        """
+        file = self.directory.joinpath('HMDB_files/hmdb_metabolites.xml')
+        self.clear_tables()
+        header, footer, ranges = hmdb_xml.metabolite_ranges(file, BUILDER_BATCH_SIZE)
+        count = 1
+        parsed = 0
+        pending = deque()
+
+        def merge(future, records):
+            nonlocal count, parsed
+            count = self.merge_range(count, *future.result())
+            parsed += records
+            print(f'flushed {parsed} metabolites, peak rss {self.peak_rss():.1f} MB')
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=start_range_builder,
+                                 initargs=(self.directory,)) as executor:
+            for start, end, records in ranges:
+                if len(pending) >= 2 * workers:
+                    merge(*pending.popleft())
+                pending.append((executor.submit(parse_range, file, header, footer, start, end), records))
+            while pending:
+                merge(*pending.popleft())
+        self.create_indexes()
+        print(f'parsed {parsed} metabolites, kept {count - 1}, peak rss {self.peak_rss():.1f} MB')
+
+    def parse_range(self, file, header, footer, start, end):
+        """
+        Builds the rows of the metabolites in one byte range of the xml file, run in a worker by parse_parallel
+        The range is wrapped in the header and footer of the file so it parses on its own
+        Kept metabolites are numbered from SU:1 within the range and the ontology terms are left for the parent
+        process to intern, so term ids follow file order too
+        Returns the rows of each table and the number of metabolites kept
+        """
+        self.tables = {table: [] for table in BUILDER_TABLES}
+        with open(file, 'rb') as xml:
+            xml.seek(start)
+            body = xml.read(end - start)
         count = 1
-        for i, (event, elem) in enumerate(et.iterparse(file, events=('end', 'start-ns'))):
-            if event == 'start-ns':
-                ns, url = elem
-                nsmap[ns] = url
-            elif event == 'end' and elem.tag.split('}', 1)[1] in ['metabolite']:
-                count = self.build(count, elem)
-                if count >= 1430:
-                    break
+        for elem in hmdb_xml.iter_metabolites(io.BytesIO(header + body + footer)):
+            count = self.build(count, elem)
+        return self.tables, count - 1
+
+    def merge_range(self, count, tables, kept):
+        """
+        Adds the rows of a range from parse_range to the table buffers and flushes them to the db file
+        The SU ids of the range are moved on to follow the count metabolites kept before it, and its ontology terms
+        are interned by save_to_db
+        Returns the SU number for the next range
+        """
+        for table in BUILDER_TABLES:
+            for row in tables[table]:
+                if 'metabolite_id' in row:
+                    row['metabolite_id'] = f'SU:{int(row["metabolite_id"][3:]) + count - 1}'
+                self.tables[table].append(row)
+        self.save_to_db()
+        return count + kept
+
+    def peak_rss(self):
+        """
+        Returns the peak resident memory of the process in MB, ru_maxrss is in kB on linux
+        """
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# the Builder of a parse_parallel worker process, made once per process by start_range_builder
+range_builder = None
+
+
+def start_range_builder(directory):
+    global range_builder
+    range_builder = Builder(directory)
+
+
+def parse_range(file, header, footer, start, end):
+    return range_builder.parse_range(file, header, footer, start, end)
 
 
 class Reader:
@@ -232,7 +391,7 @@ class Reader:
         self.samples = pd.DataFrame(columns=self.sampletitles)
         self.sample_key = 1
 
-        self.spectratitles = ['spectrum_id', 'sample_id', 'frequency', 'temperature', 'data_source']
+        self.spectratitles = ['spectrum_id', 'sample_id', 'nucleus', 'frequency', 'temperature', 'data_source']
         self.spectra = pd.DataFrame(columns=self.spectratitles)
         self.spectrum_key = 1
 
@@ -270,7 +429,7 @@ class Reader:
         for index, metabolite in metabolites.iterrows():
             metabolite_id = metabolite['metabolite_id']
             accession = metabolite['hmdb_accession']
-            nmrml_expr = re.compile(f'{accession}_.*_1H.nmrML')
+            nmrml_expr = re.compile(f'{accession}_.*_(1H|13C).nmrML')
             text_expr = re.compile(f'{accession}_nmroned.*')
             xml_expr = re.compile(f'{accession}_nmr_one_d.*')
             nmrml_metabolites = list(filter(nmrml_expr.match, nmrmlfiles))
@@ -303,7 +462,13 @@ class Reader:
                              'sample_id': sample_id,
                              'data_source': 'nmrML'}
             file = directory.joinpath(file)
-            if not str(file).endswith('.nmrML') or not '1H' in str(file):
+            if not str(file).endswith('.nmrML'):
+                continue
+            if str(file).endswith('_13C.nmrML'):
+                spectrum_data['nucleus'] = '13C'
+            elif '1H' in str(file):
+                spectrum_data['nucleus'] = '1H'
+            else:
                 continue
             tree = et.parse(file)
             root = tree.getroot()
@@ -374,8 +539,7 @@ class Reader:
                              'data_source': 'txt'}
             file = directory.joinpath(file)
             locations = self.find_tables(file)
-            if locations == 'C13':
-                continue
+            spectrum_data['nucleus'] = locations['nucleus']
             sample_data, spectrum_data = self.supplement_with_xml(file, sample_data, spectrum_data)
             self.samples = self.samples.append(pd.Series(sample_data, index=self.samples.columns), ignore_index=True)
             self.sample_key += 1
@@ -412,6 +576,25 @@ class Reader:
                             self.peaks.loc[self.peak_key] = peak_data
                             self.peak_key += 1
                             peak_count += 1
+            elif peaks is not None:
+                # without a multiplet table, as in 13C peak lists, each peak is its own multiplet like the xml files
+                for j, peak in peaks.iterrows():
+                    multiplet_id = f'MT:{spectrum_id.split(":")[-1]}.{j + 1}'
+                    multiplet_data = {'multiplet_id': multiplet_id,
+                                      'spectrum_id': spectrum_id,
+                                      'center': peak['(ppm)'],
+                                      'atom_ref': None,
+                                      'multiplicity': None}
+                    peak_data = {'peak_id': f'PK:{spectrum_id.split(":")[-1]}.{j + 1}',
+                                 'spectrum_id': spectrum_id,
+                                 'multiplet_id': multiplet_id,
+                                 'shift': peak['(ppm)'],
+                                 'intensity': peak['Height'],
+                                 'width': 0.004}
+                    self.multiplets.loc[self.multiplet_key] = multiplet_data
+                    self.multiplet_key += 1
+                    self.peaks.loc[self.peak_key] = peak_data
+                    self.peak_key += 1
 
     def parsexml(self, files, metabolite_id):
         """
@@ -430,8 +613,7 @@ class Reader:
                              'data_source': 'xml'}
             tree = et.parse(file)
             root = tree.getroot()
-            if root.find('nucleus').text == '13C':
-                continue
+            spectrum_data['nucleus'] = root.find('nucleus').text
             sample_data, spectrum_data = self.xml_sample_and_spectrum_data(root, sample_data, spectrum_data)
             self.samples = self.samples.append(pd.Series(sample_data, index=self.samples.columns), ignore_index=True)
             self.sample_key += 1
@@ -458,8 +640,8 @@ class Reader:
         """
         Method for gathering data from xml files, specifically for supplementing txt or nmrml files.
         Takes the txt or nmrml file name, the current sample data and current spectrum data.
-        The method then looks for the appropriate xml file and fills in any gaps in the sample/spectrum data by calling
-        the xml_sample_and_spectrum_data method.
+        The method then looks for the appropriate xml file of the same nucleus and fills in any gaps in the
+        sample/spectrum data by calling the xml_sample_and_spectrum_data method.
         Returns updated sample and spectrum data.
         """
         accession = str(file.name).split('_')[0]
@@ -479,7 +661,7 @@ class Reader:
             file = self.directory.joinpath(f'HMDB_files/xml_files/{filetarget}')
             tree = et.parse(file)
             root = tree.getroot()
-            if root.find('nucleus').text == '13C':
+            if root.find('nucleus').text != spectrum_data['nucleus']:
                 continue
             else:
                 sample_data, spectrum_data = self.xml_sample_and_spectrum_data(root, sample_data, spectrum_data)
@@ -490,7 +672,7 @@ class Reader:
                 file = self.directory.joinpath(f'HMDB_files/xml_files/{filetarget}')
                 tree = et.parse(file)
                 root = tree.getroot()
-                if root.find('nucleus').text == '13C':
+                if root.find('nucleus').text != spectrum_data['nucleus']:
                     continue
                 else:
                     sample_data, spectrum_data = self.xml_sample_and_spectrum_data(root, sample_data, spectrum_data)
@@ -545,7 +727,9 @@ class Reader:
         Gathers either peak or multiplet data from text files>
         Returns a pandas dataframe identical to the table from the text file.
         """
-        if locations == 'C13':
+        if locations['nucleus'] == '13C':
+            if feature == 'peaks':
+                return self.get_xwinnmr_peaks(file)
             return None
         startline = locations[feature]
         if startline == -1:
@@ -579,16 +763,38 @@ class Reader:
             return None
         return df
 
+    def get_xwinnmr_peaks(self, file):
+        """
+        Gathers the peaks of a 13C peak list exported from xwinnmr.
+        Its table rows are the peak number, address, frequency in Hz, shift in ppm and intensity.
+        Returns a pandas dataframe with the same '(ppm)' and 'Height' columns as the 1H peak tables.
+        """
+        table = []
+        with open(file, 'r') as text:
+            for line in text.readlines():
+                row = line.split()
+                if len(row) < 4 or not row[0].isdigit():
+                    continue
+                try:
+                    table.append([row[0], float(row[-2]), float(row[-1])])
+                except ValueError:
+                    continue
+        df = pd.DataFrame(table, columns=['No', '(ppm)', 'Height'])
+        if df.empty:
+            print(f'empty peak table in file: {file}')
+            return None
+        return df
+
     def find_tables(self, file):
         """
-        Finds the line where the peak and multiplet tables start in the text file.
-        Returns a dictionary on success or a string on fail.
+        Finds the line where the peak and multiplet tables start in the text file, and its nucleus.
+        Returns a dictionary, 13C peak lists from xwinnmr have no table locations.
         """
-        locations = {}
+        locations = {'nucleus': '1H'}
         file = open(file, 'r')
         for i, line in enumerate(file.readlines()):
             if line.startswith('DUoptxwinnmr'):
-                return 'C13'
+                return {'nucleus': '13C'}
             if 'peaks' in line.casefold():
                 locations['peaks'] = i
             if 'multiplets' in line.casefold():
@@ -614,7 +820,6 @@ if __name__ == "__main__":
     directory = '/home/mh491/Database'
     # builder = Builder(directory)
     # builder.parse_metabolites()
-    # builder.save_to_db()
 
     reader = Reader(directory)
     reader.run()
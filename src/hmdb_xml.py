@@ -0,0 +1,124 @@
+"""
+Streaming access to the metabolite records of hmdb_metabolites.xml and the fields the Builder takes from them.
+lxml is used when it is installed: its iterparse only builds the metabolite elements asked for and the fields are
+read by compiled XPath. Without lxml the same records are read with ElementTree.
+"""
+
+import mmap
+import re
+import xml.etree.ElementTree as et
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+HMDB = '{http://www.hmdb.ca}'
+NAMESPACES = {'hmdb': 'http://www.hmdb.ca'}
+METABOLITE_TAG = f'{HMDB}metabolite'
+# the start and end tags of a metabolite record as they appear in the file
+METABOLITE_START = re.compile(rb'<metabolite[\s>]')
+METABOLITE_END = b'</metabolite>'
+
+if etree is not None:
+    LEAVES = etree.XPath('*[not(*)]')
+    SYNONYMS = etree.XPath('hmdb:synonyms/hmdb:synonym', namespaces=NAMESPACES)
+    TERMS = etree.XPath('hmdb:ontology//hmdb:term[not(*)]', namespaces=NAMESPACES)
+    # the term of the nearest enclosing node that has one, the node of the term itself being the first
+    PARENT_TERM = etree.XPath('ancestor::*[hmdb:term][2]/hmdb:term', namespaces=NAMESPACES)
+    CONCENTRATIONS = etree.XPath('hmdb:normal_concentrations/* | hmdb:abnormal_concentrations/*', namespaces=NAMESPACES)
+
+
+def iter_metabolites(file):
+    """
+    Yields each metabolite element of the file, a path or a binary file object, in turn.
+    An element is cleared, along with everything parsed before it, once the caller moves on to the next one,
+    so memory stays flat however large the file is.
+    """
+    if etree is not None:
+        source = file if hasattr(file, 'read') else str(file)
+        for event, elem in etree.iterparse(source, events=('end',), tag=METABOLITE_TAG, huge_tree=True):
+            yield elem
+            elem.clear(keep_tail=True)
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    else:
+        context = et.iterparse(file, events=('start', 'end'))
+        event, root = next(context)
+        for event, elem in context:
+            if event == 'end' and elem.tag == METABOLITE_TAG:
+                yield elem
+                root.clear()
+
+
+def metabolite_ranges(file, size):
+    """
+    Splits the file into byte ranges of size metabolite records each, cut at the metabolite start tags.
+    The tags are found by scanning the memory mapped file, without parsing it.
+    Returns the bytes before the first record, the bytes after the last and a (start, end, records) tuple per range.
+    A range wrapped in the bytes before and after parses as a document of its own.
+    """
+    with open(file, 'rb') as xml, mmap.mmap(xml.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        starts = [found.start() for found in METABOLITE_START.finditer(mapped)]
+        if len(starts) == 0:
+            return mapped[:], b'', []
+        end = mapped.rfind(METABOLITE_END) + len(METABOLITE_END)
+        bounds = starts[::size] + [end]
+        ranges = [(bounds[i], bounds[i + 1], min(size, len(starts) - i * size)) for i in range(len(bounds) - 1)]
+        return mapped[:starts[0]], mapped[end:], ranges
+
+
+def leaves(elem):
+    """
+    Returns the child elements of elem that have no children of their own.
+    """
+    if etree is not None and isinstance(elem, etree._Element):
+        return LEAVES(elem)
+    return [child for child in elem if len(child) == 0]
+
+
+def synonyms(elem):
+    """
+    Returns the text of each synonym of a metabolite.
+    """
+    if etree is not None and isinstance(elem, etree._Element):
+        return [synonym.text for synonym in SYNONYMS(elem)]
+    return [synonym.text for synonym in elem.iterfind(f'{HMDB}synonyms/{HMDB}synonym')]
+
+
+def ontology_terms(elem):
+    """
+    Returns a (term, definition, parent) tuple for each term of a metabolite's ontology in file order, the definition
+    being the one given next to the term and the parent the term of the node the term's node sits in, or None.
+    """
+    if etree is not None and isinstance(elem, etree._Element):
+        terms = []
+        for term in TERMS(elem):
+            parents = PARENT_TERM(term)
+            terms.append((term.text, term.getparent().findtext(f'{HMDB}definition'),
+                          parents[0].text if parents else None))
+        return terms
+    terms = []
+
+    def walk(node, parent):
+        term = node.find(f'{HMDB}term')
+        if term is not None and len(term) == 0:
+            terms.append((term.text, node.findtext(f'{HMDB}definition'), parent))
+            parent = term.text
+        for child in node:
+            walk(child, parent)
+
+    ontology = elem.find(f'{HMDB}ontology')
+    if ontology is not None:
+        walk(ontology, None)
+    return terms
+
+
+def concentrations(elem):
+    """
+    Returns the normal and then the abnormal concentration elements of a metabolite.
+    """
+    if etree is not None and isinstance(elem, etree._Element):
+        return CONCENTRATIONS(elem)
+    return (list(elem.iterfind(f'{HMDB}normal_concentrations/*')) +
+            list(elem.iterfind(f'{HMDB}abnormal_concentrations/*')))
@@ -2,20 +2,296 @@
 import pathlib
 import os
 import csv
+import fcntl
 import sys
+import argparse
+import heapq
+import json
+import shutil
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+import numpy as np
+
+# upper bound on the number of peak/target distances held in memory at once while scoring,
+# kept small enough for the working arrays of a block to stay in cache
+MAX_BLOCK_SIZE = 65_536
+
+# width in ppm of the bins in the inverted index used to prune candidate spectra
+BIN_WIDTH = 0.01
+# fewer pruned candidates than this and the query falls back to scoring the whole library
+MIN_CANDIDATES = 10
+# number of queries scored together in one pass by Match.top_k_batch
+BATCH_SIZE = 64
+# size of the least recently used cache of top_k results, and the ppm steps query shifts are rounded to for its keys
+CACHE_SIZE = 1024
+CACHE_TOLERANCE = 0.001
+
+# the csv libraries that are loaded, and the directory their compiled binary form is kept in
+SOURCE_DIRECTORIES = ['hmdb_nmr_spectra', 'bmrb_nmr_spectra']
+COMPILED_DIRECTORY = 'compiled_library'
+# the sqlite databases built by database_builder.Reader and bmrb_pynmrstar_reader.BMRB_Reader
+SOURCE_DATABASES = ['ccpn_metabolites_hmdb.db', 'ccpn_metabolites_bmrb.db']
+COMPILED_DATABASE_DIRECTORY = 'compiled_database_library'
+# the nuclei the databases hold 1D spectra of, databases without a nucleus column only hold 1H spectra
+NUCLEI = ['1H', '13C']
+# rows fetched at a time while streaming peaks out of a database
+FETCH_SIZE = 10_000
+COMPILED_VERSION = 3
+# arrays of a compiled library, each kept in its own .npy file so it can be memory-mapped
+COMPILED_ARRAYS = ['library', 'offsets', 'index', 'bins', 'bin_offsets', 'bin_spectra']
+# string tables of a compiled library, one entry per spectrum
+COMPILED_STRINGS = ['ids', 'spectrum_ids', 'names']
+# prefix of the generation directories a compiled library is written to, see new_generation
+COMPILED_GENERATION = 'library_'
+# experimental conditions kept for every spectrum, as numbers or as lower case labels, missing ones are nan or -1
+NUMERIC_CONDITIONS = ['frequency', 'ph', 'temperature']
+LABEL_CONDITIONS = ['solvent', 'reference', 'source']
+# the library each source file or directory belongs to, for the source condition
+SOURCE_NAMES = {'hmdb_nmr_spectra': 'hmdb',
+                'bmrb_nmr_spectra': 'bmrb',
+                'ccpn_metabolites_hmdb.db': 'hmdb',
+                'ccpn_metabolites_bmrb.db': 'bmrb'}
+
+Hit = namedtuple('Hit', ['score', 'id', 'name'])
+
+
+def stream_peaks(path, columns=(), nucleus='1H'):
+    """
+    Streams the peaks of a database built by the readers in one query over the peaks table joined through
+    spectra and samples to metabolites, fetched FETCH_SIZE rows at a time.
+    Spectra are identified by the metabolite accession where the metabolites table has one.
+    Only the spectra of the given nucleus are streamed, or those of every nucleus when it is None.
+    Yields (id, spectrum_id, name, shift) rows followed by any extra sql columns asked for.
+    """
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        names = [row[1] for row in conn.execute('pragma table_info(metabolites)')]
+        accession = next((name for name in ['accession', 'hmdb_accession'] if name in names), 'metabolite_id')
+        extra = ''.join(f', {column}' for column in columns)
+        where, parameters = '', ()
+        if nucleus is not None:
+            if 'nucleus' in [row[1] for row in conn.execute('pragma table_info(spectra)')]:
+                where, parameters = 'and spectra.nucleus = ?', (nucleus,)
+            elif nucleus != '1H':
+                return
+        sql = f''' select cast(metabolites."{accession}" as text), peaks.spectrum_id,
+                          coalesce(metabolites.name, ''), cast(peaks.shift as real){extra}
+                   from peaks
+                   join spectra on spectra.spectrum_id = peaks.spectrum_id
+                   join samples on samples.sample_id = spectra.sample_id
+                   join metabolites on metabolites.metabolite_id = samples.metabolite_id
+                   where peaks.shift is not null {where} '''
+        cursor = conn.execute(sql, parameters)
+        rows = cursor.fetchmany(FETCH_SIZE)
+        while rows:
+            yield from rows
+            rows = cursor.fetchmany(FETCH_SIZE)
+    finally:
+        conn.close()
+
+
+def condition_columns(path):
+    """
+    Builds the sql columns that read the conditions of each spectrum from a database built by the readers.
+    The Builder keeps the temperature with the spectrum and BMRB_Reader with the sample, and any condition
+    a database does not have at all is read as null.
+    Returns the columns in the order frequency, ph, temperature, solvent, reference.
+    """
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        tables = {table: [row[1].lower() for row in conn.execute(f'pragma table_info({table})')]
+                  for table in ['spectra', 'samples']}
+    finally:
+        conn.close()
+    columns = []
+    for name in ['frequency', 'ph', 'temperature', 'solvent', 'reference']:
+        table = next((table for table in ['spectra', 'samples'] if name in tables[table]), None)
+        columns.append(f'{table}."{name}"' if table is not None else 'null')
+    return columns
+
+
+def condition_number(value):
+    """
+    Reads a numeric condition such as 7.0, '7.4' or '600 MHz', returning nan when there is none.
+    """
+    try:
+        return float(str(value).split()[0])
+    except (ValueError, IndexError):
+        return float('nan')
+
+
+def condition_label(value):
+    if value is None or str(value).strip() == '':
+        return None
+    return str(value).strip().lower()
+
+
+def new_generation(directory, prefix):
+    """
+    Makes a fresh, uniquely named directory inside directory for a new set of compiled files.
+    Compiled files may be memory-mapped by other processes, so they are never written over: a new set goes in
+    a new generation and publish then switches the manifest to it.
+    """
+    directory.mkdir(exist_ok=True)
+    return pathlib.Path(tempfile.mkdtemp(prefix=prefix, dir=directory))
+
+
+@contextmanager
+def compile_lock(directory, name='compile.lock'):
+    """
+    Holds an exclusive lock on a file in directory while compiled files are written and published,
+    so processes compiling at the same time take turns rather than racing.
+    """
+    directory.mkdir(exist_ok=True)
+    with open(directory.joinpath(name), 'a') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def publish(directory, name, manifest, prefix):
+    """
+    Atomically replaces the manifest called name in directory, which points at manifest['generation'],
+    then removes the generation the replaced manifest pointed at.
+    Only that generation is removed, so a generation another process is still writing is never touched.
+    Removing a generation only unlinks its files, processes that have them mapped keep reading the old data.
+    """
+    try:
+        with open(directory.joinpath(name), 'r') as file:
+            previous = json.load(file).get('generation')
+    except (OSError, ValueError, AttributeError):
+        previous = None
+    temporary = directory.joinpath(f'{name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    with open(temporary, 'w') as file:
+        json.dump(manifest, file)
+    os.replace(temporary, directory.joinpath(name))
+    if isinstance(previous, str) and previous.startswith(prefix) and previous == pathlib.Path(previous).name \
+            and previous != manifest['generation']:
+        shutil.rmtree(directory.joinpath(previous), ignore_errors=True)
+
+
+def smallest(scores, spectra, k):
+    """
+    Picks the k lowest scores with a bounded heap, breaking ties by spectrum index.
+    Large score arrays are first cut down to the entries no worse than the k-th best.
+    Returns a list of (score, spectrum) pairs, best first.
+    """
+    if 0 < k < len(scores):
+        kept = scores <= np.partition(scores, k - 1)[k - 1]
+        scores, spectra = scores[kept], spectra[kept]
+    return heapq.nsmallest(k, zip(scores.tolist(), spectra.tolist()))
+
+
+def parse_query(line, number):
+    """
+    Reads one streamed query: a json object with "shifts" and an optional "id", a json list of shifts,
+    or a csv line of shifts that may start with an id. Blank lines give None.
+    Returns the query id, defaulting to the line number, and its list of shifts.
+    Raises ValueError or TypeError for a line that is not a query, see query_shifts.
+    """
+    line = line.strip()
+    if not line:
+        return None
+    if line.startswith('{'):
+        query = json.loads(line)
+        if 'shifts' not in query:
+            raise ValueError('query has no "shifts"')
+        return query.get('id', number), query_shifts(query['shifts'])
+    if line.startswith('['):
+        return number, query_shifts(json.loads(line))
+    fields = [field.strip() for field in next(csv.reader([line], delimiter=',', quotechar='"'))]
+    if len(fields) == 1:
+        fields = fields[0].split()
+    fields = [field for field in fields if field]
+    try:
+        float(fields[0])
+    except (ValueError, IndexError):
+        # the first field is an id
+        return fields[0], query_shifts(fields[1:])
+    return number, query_shifts(fields)
+
+
+def query_shifts(values):
+    """
+    Turns the shifts of a streamed query into floats.
+    Raises ValueError unless they are a non-empty list of finite numbers.
+    """
+    if not isinstance(values, list):
+        raise ValueError('query "shifts" is not a list')
+    if len(values) == 0:
+        raise ValueError('query has no shifts')
+    if any(isinstance(value, bool) for value in values):
+        raise ValueError('query has a shift that is not a number')
+    shifts = [float(value) for value in values]
+    if not all(np.isfinite(shifts)):
+        raise ValueError('query has a shift that is not a finite number')
+    return shifts
+
+
+def format_hits(hits):
+    """
+    Formats a list of hits from Match.top_k as the text table printed by Match.match.
+    """
+    lines = [f"score    id             molecule",
+             f"-----    --             --------"]
+    for hit in hits:
+        lines.append("%-7.3f  %-10s     %-s" % (hit.score, hit.id, hit.name))
+    return '\n'.join(lines)
+
 
 class Match:
     def __init__(self):
         self.shifts = {}
         self.names = {}
+        self.spectrum_conditions = {}
+        # the nucleus of the spectra loaded from the databases, the csv libraries are all 1H
+        self.nucleus = '1H'
+
+        # the library as one ragged array, spectrum i owns library[offsets[i]:offsets[i + 1]]
+        # shifts are sorted within each spectrum and index holds them as one globally sorted search key
+        self.keys = []
+        self.library = np.empty(0)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.index = np.empty(0)
+        self.index_base = 0.0
+        self.index_span = 1.0
+
+        # inverted index: the spectra with a peak in bin bins[j] are bin_spectra[bin_offsets[j]:bin_offsets[j + 1]]
+        self.bin_width = BIN_WIDTH
+        self.bins = np.empty(0, dtype=np.int64)
+        self.bin_offsets = np.zeros(1, dtype=np.int64)
+        self.bin_spectra = np.empty(0, dtype=np.int64)
+
+        # per spectrum condition arrays in the order of keys, label conditions hold codes into condition_labels
+        self.conditions = {}
+        self.condition_labels = {}
+
+        # top_k results by library version and rounded query, cleared whenever the library changes
+        self.version = 0
+        self.cache = OrderedDict()
+        self.cache_size = CACHE_SIZE
+        self.cache_tolerance = CACHE_TOLERANCE
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_lock = threading.Lock()
 
     def load_shifts(self,path):
 
+        source = SOURCE_NAMES.get(pathlib.Path(path).name, pathlib.Path(path).name)
         path =pathlib.Path(path,'id_shifts.csv')
         with open(path, 'r') as csvfile:
             reader = csv.reader(csvfile, delimiter=',', quotechar='"')
             for row in reader:
                 self.shifts[(row[0],row[1])] = [float(elem) for elem in row[2:]]
+                self.spectrum_conditions[(row[0],row[1])] = {'source': source}
 
     def load_names(self,path):
 
@@ -25,13 +301,321 @@ class Match:
             for row in reader:
                 self.names[row[0]] = row[1]
 
-    def load(self):
-        cwd = '/home/mh491/Metameta_Files'
-        for directory in ['hmdb_nmr_spectra', 'bmrb_nmr_spectra']:
-            path = (pathlib.Path(cwd,directory))
+    def load_database(self, path):
+        """
+        Loads the shifts and conditions of every spectrum of self.nucleus in a database built by the readers.
+        """
+        source = SOURCE_NAMES.get(pathlib.Path(path).name, pathlib.Path(path).stem)
+        for id, spectrum_id, name, shift, *conditions in stream_peaks(path, condition_columns(path), self.nucleus):
+            key = (id, spectrum_id)
+            if key not in self.shifts:
+                self.shifts[key] = []
+                self.names[id] = name
+                frequency, ph, temperature, solvent, reference = conditions
+                self.spectrum_conditions[key] = {'frequency': frequency,
+                                                 'ph': ph,
+                                                 'temperature': temperature,
+                                                 'solvent': solvent,
+                                                 'reference': reference,
+                                                 'source': source}
+            self.shifts[key].append(shift)
+
+    def load(self, cwd='/home/mh491/Metameta_Files'):
+        """
+        Loads the hmdb and bmrb libraries from their csv files.
+        """
+        paths = [pathlib.Path(cwd, directory) for directory in SOURCE_DIRECTORIES]
+        files = [path.joinpath(file) for path in paths for file in ['id_shifts.csv', 'id_name.csv']]
+        self.load_cached(pathlib.Path(cwd, COMPILED_DIRECTORY), files, self.read_csv, paths)
+
+    def load_databases(self, cwd='/home/mh491/Database', nucleus='1H'):
+        """
+        Loads the hmdb and bmrb libraries of one nucleus straight from the databases built by the readers.
+        Each nucleus is compiled into a directory of its own.
+        """
+        self.nucleus = nucleus
+        paths = [pathlib.Path(cwd, database) for database in SOURCE_DATABASES]
+        compiled = COMPILED_DATABASE_DIRECTORY if nucleus == '1H' else f'{COMPILED_DATABASE_DIRECTORY}_{nucleus}'
+        self.load_cached(pathlib.Path(cwd, compiled), paths, self.read_databases, paths)
+
+    def read_csv(self, paths):
+        for path in paths:
             self.load_shifts(path)
             self.load_names(path)
 
+    def read_databases(self, paths):
+        for path in paths:
+            self.load_database(path)
+
+    def load_cached(self, compiled, files, read, paths):
+        """
+        Uses the compiled binary library when it is up to date with the source files, otherwise calls read
+        on the source paths and compiles the result again for next time.
+        Compiling holds compile_lock, and a process that had to wait for it uses the library compiled meanwhile.
+        """
+        sources = self.sources(files)
+        if self.is_current(compiled, sources):
+            try:
+                self.load_compiled(compiled)
+                return
+            except (OSError, ValueError) as e:
+                # another process replaced the library while it was being loaded
+                print(e)
+        built = False
+        try:
+            with compile_lock(compiled):
+                if self.is_current(compiled, sources):
+                    self.load_compiled(compiled)
+                    return
+                read(paths)
+                self.build_library()
+                built = True
+                self.compile(compiled, sources)
+                self.load_compiled(compiled)
+        except (OSError, ValueError) as e:
+            # the library is used from memory when it cannot be compiled
+            print(e)
+            if not built:
+                read(paths)
+                self.build_library()
+
+    def sources(self, files):
+        """
+        Records the size and modification time of each source file the library is loaded from.
+        """
+        sources = {}
+        for path in files:
+            stat = path.stat()
+            sources[str(path)] = [stat.st_size, stat.st_mtime_ns]
+        return sources
+
+    def is_current(self, compiled, sources):
+        """
+        Checks whether a compiled library exists and was built from the source files as they are now.
+        """
+        try:
+            with open(compiled.joinpath('manifest.json'), 'r') as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return False
+        return manifest.get('version') == COMPILED_VERSION and manifest.get('sources') == sources
+
+    def compile(self, compiled, sources):
+        """
+        Writes the loaded library to a compact binary form: float32 shifts, the offsets and search indexes
+        as .npy files and the ids and names as null separated utf-8 string tables.
+        The files go in a new generation directory and the manifest is switched to it last, see publish, so a
+        partly written library is never taken as current and a library another process has mapped is never
+        written over.
+        """
+        generation = new_generation(compiled, COMPILED_GENERATION)
+        self.library = self.library.astype(np.float32)
+        self.build_index()
+        for name in COMPILED_ARRAYS:
+            np.save(generation.joinpath(f'{name}.npy'), getattr(self, name))
+        strings = {'ids': [key[0] for key in self.keys],
+                   'spectrum_ids': [key[1] for key in self.keys],
+                   'names': [self.names.get(key[0], '') for key in self.keys]}
+        for name in COMPILED_STRINGS:
+            data = '\0'.join(strings[name]).encode('utf-8')
+            np.save(generation.joinpath(f'{name}.npy'), np.frombuffer(data, dtype=np.uint8))
+        for name in NUMERIC_CONDITIONS + LABEL_CONDITIONS:
+            np.save(generation.joinpath(f'condition_{name}.npy'), self.conditions[name])
+        publish(compiled, 'manifest.json', {'version': COMPILED_VERSION,
+                                            'generation': generation.name,
+                                            'sources': sources,
+                                            'condition_labels': self.condition_labels,
+                                            'index_base': self.index_base,
+                                            'index_span': self.index_span,
+                                            'bin_width': self.bin_width,
+                                            'spectra': len(self.keys)}, COMPILED_GENERATION)
+        # libraries compiled before generations were used kept their arrays in the directory itself
+        for path in compiled.glob('*.npy'):
+            path.unlink()
+
+    def load_compiled(self, compiled):
+        """
+        Loads a library written by compile, memory-mapping the arrays rather than reading them.
+        Every file is opened before any attribute is set, so a library replaced part way through loading raises
+        without leaving a mix of two libraries behind.
+        """
+        with open(compiled.joinpath('manifest.json'), 'r') as file:
+            manifest = json.load(file)
+        generation = compiled.joinpath(manifest['generation'])
+        # plain ndarray views of the maps, indexing a memmap subclass is slower in the scoring loops
+        arrays = {name: np.asarray(np.load(generation.joinpath(f'{name}.npy'), mmap_mode='r'))
+                  for name in COMPILED_ARRAYS}
+        strings = {}
+        for name in COMPILED_STRINGS:
+            data = np.load(generation.joinpath(f'{name}.npy'), mmap_mode='r')
+            strings[name] = data.tobytes().decode('utf-8').split('\0') if manifest['spectra'] > 0 else []
+        conditions = {name: np.asarray(np.load(generation.joinpath(f'condition_{name}.npy'), mmap_mode='r'))
+                      for name in NUMERIC_CONDITIONS + LABEL_CONDITIONS}
+        for name in COMPILED_ARRAYS:
+            setattr(self, name, arrays[name])
+        self.index_base = manifest['index_base']
+        self.index_span = manifest['index_span']
+        self.bin_width = manifest['bin_width']
+        self.conditions = conditions
+        self.condition_labels = manifest['condition_labels']
+        self.shifts = {}
+        self.spectrum_conditions = {}
+        self.keys = list(zip(strings['ids'], strings['spectrum_ids']))
+        self.names = dict(zip(strings['ids'], strings['names']))
+        self.reset_cache()
+
+    def build_library(self):
+        """
+        Packs self.shifts into a single flat array of shifts with per-spectrum offsets.
+        Spectra without any shifts can never be scored and are left out.
+        """
+        self.keys = [key for key in self.shifts if len(self.shifts[key]) > 0]
+        lengths = [len(self.shifts[key]) for key in self.keys]
+        self.offsets = np.zeros(len(self.keys) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.library = np.fromiter(chain.from_iterable(self.shifts[key] for key in self.keys),
+                                   dtype=float, count=self.offsets[-1])
+        self.build_index()
+        self.build_bins()
+        self.build_conditions()
+        self.reset_cache()
+
+    def build_index(self):
+        """
+        Sorts the shifts within each spectrum and builds the search index used for nearest shift lookups.
+        Each spectrum gets its own band of width index_span in the index, so a single sorted array serves
+        a binary search into any spectrum.
+        """
+        owners = np.repeat(np.arange(len(self.keys)), np.diff(self.offsets))
+        self.library = self.library[np.lexsort((self.library, owners))]
+        if len(self.library) == 0:
+            self.index = np.empty(0)
+            return
+        self.index_base = float(self.library.min())
+        self.index_span = float(self.library.max()) - self.index_base + 1.0
+        self.index = (self.library - self.index_base) + owners * self.index_span
+
+    def build_bins(self):
+        """
+        Builds the inverted index from fixed width ppm bins to the spectra that have a peak in that bin.
+        """
+        owners = np.repeat(np.arange(len(self.keys)), np.diff(self.offsets))
+        peak_bins = np.floor(self.library / self.bin_width).astype(np.int64)
+        pairs = np.unique(peak_bins * len(self.keys) + owners)
+        self.bins, counts = np.unique(pairs // max(len(self.keys), 1), return_counts=True)
+        self.bin_offsets = np.zeros(len(self.bins) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.bin_offsets[1:])
+        self.bin_spectra = pairs % max(len(self.keys), 1)
+
+    def build_conditions(self):
+        """
+        Builds the per spectrum condition arrays from the conditions loaded with each spectrum.
+        Numeric conditions become float arrays and label conditions codes into a sorted list of their labels.
+        """
+        conditions = [self.spectrum_conditions.get(key, {}) for key in self.keys]
+        self.conditions = {}
+        self.condition_labels = {}
+        for name in NUMERIC_CONDITIONS:
+            self.conditions[name] = np.array([condition_number(condition.get(name)) for condition in conditions],
+                                             dtype=float)
+        for name in LABEL_CONDITIONS:
+            labels = [condition_label(condition.get(name)) for condition in conditions]
+            self.condition_labels[name] = sorted(set(label for label in labels if label is not None))
+            codes = {label: code for code, label in enumerate(self.condition_labels[name])}
+            self.conditions[name] = np.array([codes.get(label, -1) for label in labels], dtype=np.int32)
+
+    def spectra_where(self, ph=None, temperature=None, min_frequency=None, solvent=None, reference=None, source=None):
+        """
+        Finds the spectra recorded under the given conditions, for instance ph=(6.5, 7.5), solvent='D2O',
+        min_frequency=600, source='hmdb'. Ranges are (low, high) pairs, labels a label or a list of labels and
+        match regardless of case. A spectrum missing a condition that is asked for never matches.
+        Returns an array of spectrum indices, or None when no condition is given.
+        """
+        mask = np.ones(len(self.keys), dtype=bool)
+        filtered = False
+        for name, allowed in [('ph', ph), ('temperature', temperature)]:
+            if allowed is not None:
+                values = self.conditions[name]
+                mask &= (values >= allowed[0]) & (values <= allowed[1])
+                filtered = True
+        if min_frequency is not None:
+            mask &= self.conditions['frequency'] >= min_frequency
+            filtered = True
+        for name, allowed in [('solvent', solvent), ('reference', reference), ('source', source)]:
+            if allowed is not None:
+                allowed = [allowed] if isinstance(allowed, str) else allowed
+                labels = self.condition_labels[name]
+                codes = [labels.index(label) for label in map(condition_label, allowed) if label in labels]
+                mask &= np.isin(self.conditions[name], codes)
+                filtered = True
+        return np.flatnonzero(mask) if filtered else None
+
+    def candidates(self, target_shifts, tolerance=None, min_hits=None, min_candidates=MIN_CANDIDATES, spectra=None):
+        """
+        Uses the inverted bin index to find the spectra worth scoring against the target shifts.
+        A target hits a spectrum if the spectrum has a peak in a bin within tolerance (default one bin) of it,
+        and a spectrum is a candidate if at least min_hits targets hit it (default half of the targets).
+        Only the given spectra, by default the whole library, can be candidates.
+        Returns an array of spectrum indices, or all the spectra when fewer than min_candidates are found.
+        """
+        targets = np.asarray(target_shifts, dtype=float)
+        everything = np.arange(len(self.keys)) if spectra is None else spectra
+        if len(targets) == 0 or len(self.bins) == 0:
+            return everything
+        if tolerance is None:
+            tolerance = self.bin_width
+        if min_hits is None:
+            min_hits = (len(targets) + 1) // 2
+        lows = np.searchsorted(self.bins, np.floor((targets - tolerance) / self.bin_width), side='left')
+        highs = np.searchsorted(self.bins, np.floor((targets + tolerance) / self.bin_width), side='right')
+        hits = np.zeros(len(self.keys), dtype=np.int64)
+        for low, high in zip(lows, highs):
+            hit = np.unique(self.bin_spectra[self.bin_offsets[low]:self.bin_offsets[high]])
+            hits[hit] += 1
+        result = np.flatnonzero(hits >= min_hits)
+        if spectra is not None:
+            result = result[np.isin(result, spectra)]
+        if len(result) < min_candidates:
+            return everything
+        return result
+
+    def nearest(self, target_shifts, spectra=None):
+        """
+        Finds the distance from each target shift to the nearest shift of each spectrum by binary search.
+        Takes the targets and optionally an array of spectrum indices, by default the whole library.
+        The targets may also be a (spectra, targets) array giving every spectrum targets of its own.
+        Returns a (spectra, targets) array of distances.
+        """
+        targets = np.asarray(target_shifts, dtype=float)
+        if spectra is None:
+            spectra = np.arange(len(self.keys))
+        if targets.ndim == 1:
+            targets = targets[None, :]
+        starts = self.offsets[spectra][:, None]
+        ends = self.offsets[spectra + 1][:, None] - 1
+        queries = (targets - self.index_base) + spectra[:, None] * self.index_span
+        positions = np.searchsorted(self.index, queries)
+        left = self.library[np.clip(positions - 1, starts, ends)]
+        right = self.library[np.clip(positions, starts, ends)]
+        return np.minimum(np.abs(left - targets), np.abs(right - targets))
+
+    def score(self, target_shifts, spectra=None):
+        """
+        Scores library spectra against the target shifts.
+        The score of a spectrum is the sum over the targets of the distance to its nearest shift.
+        Returns an array of scores in the order of spectra, by default the same order as self.keys.
+        """
+        targets = np.asarray(target_shifts, dtype=float)
+        if spectra is None:
+            spectra = np.arange(len(self.keys))
+        scores = np.zeros(len(spectra))
+        if len(targets) == 0:
+            return scores
+        step = max(1, MAX_BLOCK_SIZE // len(targets))
+        for start in range(0, len(spectra), step):
+            scores[start:start + step] = self.nearest(targets, spectra[start:start + step]).sum(axis=1)
+        return scores
+
 
     def dump(self):
         for key in sorted(self.shifts):
@@ -40,45 +624,302 @@ class Match:
             print(self.shifts[key])
             print()
 
-    def match(self, *target_shifts_sets):
+    def reset_cache(self):
+        """
+        Moves to a new library version, emptying the top_k result cache.
+        """
+        with self.cache_lock:
+            self.version += 1
+            self.cache.clear()
+            self.cache_hits = 0
+            self.cache_misses = 0
+
+    def cache_info(self):
+        return {'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'size': len(self.cache),
+                'max_size': self.cache_size,
+                'version': self.version}
+
+    def top_k(self, target_shifts, k=10, bounded=False, prune=False, min_hits=None, tolerance=None,
+              min_candidates=MIN_CANDIDATES, **conditions):
+        """
+        Finds the k best scoring spectra for the target shifts, see rank.
+        Results are cached by library version, the pruning settings, conditions and the query shifts rounded to
+        cache_tolerance, so repeated queries are answered without scoring the library again.
+        Returns a list of Hit tuples, best first.
+        """
+        rounded = np.round(np.asarray(target_shifts, dtype=float) / self.cache_tolerance).astype(np.int64)
+        filters = tuple((name, value if isinstance(value, (str, float, int)) else tuple(value))
+                        for name, value in sorted(conditions.items()) if value is not None)
+        pruning = (min_hits, tolerance, min_candidates) if prune else None
+        key = (self.version, k, bounded, pruning, filters, tuple(sorted(rounded.tolist())))
+        with self.cache_lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.cache_hits += 1
+                return list(self.cache[key])
+            self.cache_misses += 1
+        hits = self.rank(target_shifts, k, bounded, prune, min_hits, tolerance, min_candidates, **conditions)
+        with self.cache_lock:
+            if key[0] == self.version and self.cache_size > 0:
+                self.cache[key] = hits
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return list(hits)
+
+    def rank(self, target_shifts, k=10, bounded=False, prune=False, min_hits=None, tolerance=None,
+             min_candidates=MIN_CANDIDATES, **conditions):
+        """
+        Finds the k best scoring spectra for the target shifts using a bounded heap,
+        so the library is never fully sorted and spectra with equal scores are all kept.
+        Ties are broken by library order.
+        With bounded set, spectra that cannot make the top k are abandoned part way through scoring,
+        see score_bounded, and the result is the same.
+        With prune set, only the candidates found in the bin index with min_hits, tolerance and min_candidates
+        are scored, see candidates. This is faster but approximate, as a spectrum can score well without
+        enough of its peaks falling in the targets' bins, so it is left off by default.
+        Any conditions, see spectra_where, limit the scoring to the spectra recorded under them.
+        Returns a list of Hit tuples, best first.
+        """
+        spectra = self.spectra_where(**conditions)
+        if prune:
+            spectra = self.candidates(target_shifts, tolerance, min_hits, min_candidates, spectra)
+        elif spectra is None:
+            spectra = np.arange(len(self.keys))
+        if bounded:
+            scores, spectra = self.score_bounded(target_shifts, spectra, k)
+        else:
+            scores = self.score(target_shifts, spectra)
+        return self.select(scores, spectra, k)
+
+    def score_bounded(self, target_shifts, spectra, k):
+        """
+        Bounded scoring: the candidates found in the bin index are scored first, and the k-th best of their
+        scores is a bound no spectrum in the top k can exceed. The bin index gives a lower bound on every
+        spectrum's score without scoring it, the distance from each target to the nearest bin the spectrum has
+        a peak in summed over the targets, and only the spectra whose lower bound is within the bound are scored.
+        Returns the exact scores of the surviving spectra and the survivors, which include every spectrum
+        that can make the top k.
+        """
+        targets = np.asarray(target_shifts, dtype=float)
+        if len(targets) == 0 or len(spectra) <= k or k <= 0 or len(self.bins) == 0:
+            return self.score(targets, spectra), spectra
+        seeds = self.candidates(targets, min_candidates=k, spectra=spectra)
+        if len(seeds) == len(spectra):
+            return self.score(targets, spectra), spectra
+        threshold = np.partition(self.score(targets, seeds), k - 1)[k - 1]
+        # a little slack so rounding in the bins or the sums can never drop a tied spectrum
+        reach = threshold + 1e-9 * max(threshold, 1.0)
+
+        # the bins were worked out before the shifts were compiled to float32, so a peak may sit this far outside
+        # its bin
+        slack = 4 * np.finfo(self.library.dtype).eps * (np.abs(targets).max() + reach + self.bin_width)
+
+        # spectra without a peak in the bins within reach of a target are further than reach from it
+        bound = np.full(len(self.keys), np.inf)
+        bound[spectra] = 0.0
+        lows = np.searchsorted(self.bins, np.floor((targets - reach - slack) / self.bin_width), side='left')
+        highs = np.searchsorted(self.bins, np.floor((targets + reach + slack) / self.bin_width), side='right')
+        for target, low, high in zip(targets, lows, highs):
+            edges = self.bins[low:high] * self.bin_width
+            gaps = np.maximum(np.maximum(edges - target, target - edges - self.bin_width) - slack, 0.0)
+            nearest = np.full(len(self.keys), np.inf)
+            np.minimum.at(nearest, self.bin_spectra[self.bin_offsets[low]:self.bin_offsets[high]],
+                          np.repeat(gaps, np.diff(self.bin_offsets[low:high + 1])))
+            bound += nearest
+        spectra = np.flatnonzero(bound <= reach)
+        return self.score(target_shifts, spectra), spectra
+
+    def top_k_batch(self, target_shifts_sets, k=10, batch_size=BATCH_SIZE, **conditions):
+        """
+        Scores many sets of target shifts against the whole library at once.
+        The targets of batch_size queries are looked up together in one vectorized pass and summed per query,
+        with the spectra split into blocks so no more than MAX_BLOCK_SIZE distances are held at a time.
+        Any conditions, see spectra_where, limit the hits to the spectra recorded under them.
+        A query with a target that is not a finite number is not scored and gets no hits.
+        Returns a list with the top_k list of hits for each query, in the order given.
+        """
+        queries = [np.asarray(target_shifts, dtype=float) for target_shifts in target_shifts_sets]
+        valid = [bool(np.isfinite(query).all()) for query in queries]
+        # with conditions only the spectra recorded under them are scored, otherwise the whole library is
+        selected = self.spectra_where(**conditions)
+        spectra = np.arange(len(self.keys)) if selected is None else selected
+        results = []
+        for start in range(0, len(queries), batch_size):
+            batch = [query if ok else np.empty(0) for query, ok in zip(queries[start:start + batch_size],
+                                                                        valid[start:start + batch_size])]
+            scores = self.score_batch(batch, spectra=selected)
+            for column in range(len(batch)):
+                results.append(self.select(scores[:, column], spectra, k) if valid[start + column] else [])
+        return results
+
+    def score_batch(self, queries, first=0, last=None, spectra=None):
+        """
+        Scores the spectra from first up to last, or the given array of spectra, against several queries.
+        Rather than a binary search per spectrum and target, all the targets are sorted once and every
+        library peak is placed among them, so each spectrum's nearest peaks follow from a running count.
+        Returns a (spectra, queries) array of scores.
+        """
+        if last is None:
+            last = len(self.keys)
+        count = last - first if spectra is None else len(spectra)
+        scores = np.zeros((count, len(queries)))
+        lengths = np.array([len(query) for query in queries], dtype=np.int64)
+        filled = np.flatnonzero(lengths)
+        if len(filled) == 0:
+            return scores
+        targets = np.concatenate([queries[j] for j in filled])
+        order = np.argsort(targets)
+        # where each target sits among the sorted targets, so the distances can be put back in query order and
+        # each query's run of targets summed on its own, one query's distances never touch another's sum
+        positions = np.empty_like(order)
+        positions[order] = np.arange(len(order))
+        bounds = np.cumsum(lengths[filled]) - lengths[filled]
+        step = max(1, MAX_BLOCK_SIZE // (len(targets) + 1))
+        for start in range(0, count, step):
+            stop = min(start + step, count)
+            if spectra is None:
+                distances = self.nearest_sorted(targets[order], first + start, first + stop)
+            else:
+                distances = self.nearest_sorted(targets[order], spectra=spectra[start:stop])
+            scores[start:stop, filled] = np.add.reduceat(distances[:, positions], bounds, axis=1)
+        return scores
+
+    def nearest_sorted(self, targets, first=0, last=None, spectra=None):
+        """
+        Finds the distance from each of the sorted targets to the nearest shift of the spectra from first up to last,
+        or of the given array of spectra.
+        Returns a (spectra, targets) array of distances.
+        """
+        if spectra is None:
+            if last is None:
+                last = len(self.keys)
+            peaks = self.library[self.offsets[first]:self.offsets[last]]
+            starts = self.offsets[first:last]
+            lengths = np.diff(self.offsets[first:last + 1])
+        else:
+            starts = self.offsets[spectra]
+            lengths = self.offsets[spectra + 1] - starts
+            # the peaks of the spectra one after another, gathered from wherever each spectrum sits
+            peaks = self.library[np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) +
+                                 np.arange(lengths.sum())]
+        count = len(starts)
+        owners = np.repeat(np.arange(count), lengths)
+        width = len(targets) + 1
+        positions = np.searchsorted(targets, peaks, side='left')
+        counts = np.bincount(owners * width + positions, minlength=count * width)
+        below = np.cumsum(counts.reshape(count, width), axis=1)[:, :-1]
+        starts = starts[:, None]
+        left = self.library[starts + np.clip(below - 1, 0, lengths[:, None] - 1)]
+        right = self.library[starts + np.minimum(below, lengths[:, None] - 1)]
+        return np.minimum(np.abs(left - targets), np.abs(right - targets))
+
+    def select(self, scores, spectra, k):
+        """
+        Picks the k lowest scores, see smallest.
+        Returns a list of Hit tuples, best first.
+        """
+        return [self.hit(score, spectrum) for score, spectrum in smallest(scores, spectra, k)]
+
+    def hit(self, score, spectrum):
+        id = self.keys[spectrum][0]
+        return Hit(score, id, self.names.get(id, '').strip(' "'))
+
+    def match(self, *target_shifts_sets, **options):
         for i,target_shifts in enumerate(target_shifts_sets):
 
             shifts_str = ["%7.3f" % shift  for shift in target_shifts]
             print (f"set {i}: {', '.join(shifts_str)}")
             print()
-            scores = {}
-            # print(target_shifts)
-
-            for id in self.shifts:
-                # print(self.shifts[id])
-                score =0.0
-                for target_shift in target_shifts:
-                    diffs  = [abs(shift - target_shift) for shift in self.shifts[id]]
-                    score+=min(diffs)
-                scores[score] = id
+            print(format_hits(self.top_k(target_shifts, 10, **options)))
 
-            sorted_scores = sorted(scores.keys())
+    def stream(self, lines, out, k=10, batch_size=BATCH_SIZE, workers=2, **conditions):
+        """
+        Matches a stream of queries, one per line (see parse_query), writing one json line of results per query
+        in input order as soon as it is ready.
+        Queries are scored batch_size at a time with top_k_batch, with at most workers batches in flight
+        so memory stays bounded however long the stream is.
+        A line that cannot be read as a query gets an error line in its place, keyed by its line number,
+        and the stream carries on.
+        """
+        pending = deque()
 
-            print(f"score    id             molecule")
-            print(f"-----    --             --------")
+        def submit(executor, batch):
+            queries = [shifts for id, shifts, error in batch if error is None]
+            return executor.submit(self.top_k_batch, queries, k, batch_size, **conditions), batch
 
-            for i in range(10):
-                best = scores[sorted_scores[i]]
-                print("%-7.3f  %-10s     %-s" % (sorted_scores[i],best[0],self.names[best[0]].strip(' "')))
+        def write(future, batch):
+            results = iter(future.result())
+            for id, shifts, error in batch:
+                if error is not None:
+                    result = {'id': id, 'error': error}
+                else:
+                    result = {'id': id, 'shifts': shifts, 'hits': [hit._asdict() for hit in next(results)]}
+                print(json.dumps(result), file=out)
+            out.flush()
 
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            batch = []
+            for number, line in enumerate(lines, 1):
+                try:
+                    query = parse_query(line, number)
+                except (ValueError, TypeError) as e:
+                    batch.append((number, None, str(e)))
+                else:
+                    if query is None:
+                        continue
+                    batch.append((*query, None))
+                if len(batch) < batch_size:
+                    continue
+                if len(pending) >= workers:
+                    write(*pending.popleft())
+                pending.append(submit(executor, batch))
+                batch = []
+            if batch:
+                pending.append(submit(executor, batch))
+            while pending:
+                write(*pending.popleft())
 
-
-
-    def run(self, *shift_sets):
+    def run(self, *shift_sets, **options):
         self.load()
         for shift_set in shift_sets:
-            self.match(shift_set)
+            self.match(shift_set, **options)
         # self.dump()
 
 
 if __name__ == '__main__':
-    match = Match()
+    parser = argparse.ArgumentParser(description='Match chemical shifts against the hmdb and bmrb libraries.')
+    parser.add_argument('shifts', nargs='*', type=float, help='the shifts of a single query')
+    parser.add_argument('--stream', metavar='FILE', help='read queries from FILE, or - for stdin, and write jsonl results')
+    parser.add_argument('--k', type=int, default=10, help='number of hits per streamed query')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='streamed queries scored together')
+    parser.add_argument('--workers', type=int, default=2, help='streamed batches in flight at once')
+    parser.add_argument('--ph', type=float, nargs=2, metavar=('LOW', 'HIGH'), help='only spectra recorded in this pH range')
+    parser.add_argument('--temperature', type=float, nargs=2, metavar=('LOW', 'HIGH'), help='only spectra recorded in this temperature range')
+    parser.add_argument('--min-frequency', type=float, help='only spectra recorded at this field strength in MHz or above')
+    parser.add_argument('--solvent', nargs='+', help='only spectra recorded in one of these solvents')
+    parser.add_argument('--reference', nargs='+', help='only spectra with one of these chemical shift references')
+    parser.add_argument('--source', nargs='+', help='only spectra from one of these libraries, hmdb or bmrb')
+    parser.add_argument('--prune', action='store_true', help='only score the candidates found in the bin index, faster but approximate')
+    parser.add_argument('--min-hits', type=int, help='targets that must hit a candidate when pruning, by default half of them')
+    parser.add_argument('--tolerance', type=float, help='ppm a target reaches either side when pruning, by default one bin')
+    args = parser.parse_args()
+    conditions = {'ph': args.ph,
+                  'temperature': args.temperature,
+                  'min_frequency': args.min_frequency,
+                  'solvent': args.solvent,
+                  'reference': args.reference,
+                  'source': args.source}
 
-    shifts = [float(arg) for arg in sys.argv[1:]]
+    match = Match()
 
-    match.run(shifts)
\ No newline at end of file
+    if args.stream is None:
+        match.run(args.shifts, prune=args.prune, min_hits=args.min_hits, tolerance=args.tolerance, **conditions)
+    else:
+        match.load()
+        if args.stream == '-':
+            match.stream(sys.stdin, sys.stdout, args.k, args.batch_size, args.workers, **conditions)
+        else:
+            with open(args.stream, 'r') as file:
+                match.stream(file, sys.stdout, args.k, args.batch_size, args.workers, **conditions)
@@ -0,0 +1,133 @@
+"""
+A long running match server that keeps the spectral library resident in memory.
+Queries are posted as json over local http and answered from a worker pool, so each one only pays for scoring
+and not for loading the library.
+
+    POST /match   {"shifts": [1.2, 3.4], "k": 10}            -> {"hits": [{"score": .., "id": .., "name": ..}]}
+    POST /batch   {"queries": [[1.2, 3.4], [2.1]], "k": 10}  -> {"results": [[hit, ...], ...]}
+    POST /reload                                             -> {"spectra": ..}
+    GET  /status                                             -> {"spectra": .., "loaded": .., "cache": {..}}
+"""
+
+import json
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from match import Match
+
+
+class MatchServer:
+    """
+    Holds the loaded Match library and the pool of workers that score queries against it.
+    A reload builds a new library in the background and swaps it in once it is complete,
+    queries already running finish against the library they started with.
+    """
+    def __init__(self, cwd='/home/mh491/Metameta_Files', host='127.0.0.1', port=8765, workers=4, databases=False):
+        self.cwd = cwd
+        self.databases = databases
+        self.address = (host, port)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.match = None
+        self.loaded = None
+        self.reload()
+
+    def reload(self):
+        """
+        Loads a fresh copy of the library, from the reader databases or the csv files, and replaces the current one.
+        Returns the number of spectra in the new library.
+        """
+        match = Match()
+        if self.databases:
+            match.load_databases(self.cwd)
+        else:
+            match.load(self.cwd)
+        with self.lock:
+            self.match = match
+            self.loaded = time.time()
+        return len(match.keys)
+
+    def current(self):
+        with self.lock:
+            return self.match
+
+    def top_k(self, shifts, k):
+        return [hit._asdict() for hit in self.current().top_k(shifts, k)]
+
+    def top_k_batch(self, queries, k):
+        return [[hit._asdict() for hit in hits] for hits in self.current().top_k_batch(queries, k)]
+
+    def handle(self, path, request):
+        """
+        Runs a request on the worker pool and waits for its json reply.
+        """
+        if path == '/match':
+            future = self.pool.submit(self.top_k, [float(shift) for shift in request['shifts']], int(request.get('k', 10)))
+            return {'hits': future.result()}
+        if path == '/batch':
+            queries = [[float(shift) for shift in query] for query in request['queries']]
+            future = self.pool.submit(self.top_k_batch, queries, int(request.get('k', 10)))
+            return {'results': future.result()}
+        if path == '/reload':
+            return {'spectra': self.pool.submit(self.reload).result()}
+        if path == '/status':
+            match = self.current()
+            return {'spectra': len(match.keys), 'loaded': self.loaded, 'cache': match.cache_info()}
+        raise KeyError(path)
+
+    def run(self):
+        server = ThreadingHTTPServer(self.address, self.handler())
+        print(f'match server listening on http://{self.address[0]}:{self.address[1]}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.pool.shutdown()
+
+    def handler(self):
+        """
+        Builds the http request handler class bound to this server.
+        """
+        match_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.respond(None)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self.respond(self.rfile.read(length) if length > 0 else b'{}')
+
+            def respond(self, body):
+                try:
+                    request = json.loads(body) if body is not None else {}
+                    reply = match_server.handle(self.path, request)
+                    status = 200
+                except KeyError as e:
+                    reply = {'error': f'unknown request or missing field {e}'}
+                    status = 404 if self.path not in ['/match', '/batch'] else 400
+                except (ValueError, TypeError) as e:
+                    reply = {'error': str(e)}
+                    status = 400
+                data = json.dumps(reply).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    server = MatchServer(port=port)
+    server.run()
@@ -0,0 +1,148 @@
+"""
+Mixture analysis: finds the set of library spectra that together explain the peaks of one query spectrum,
+as for a biofluid sample holding many metabolites at once.
+The query and the library are binned by spectral_similarity.SimilarityMatch. The library spectra that overlap
+the query most are kept as candidates, and the query is fitted as a non-negative sum of them, either in one
+non-negative least squares solve or greedily one component at a time.
+"""
+
+import sys
+from collections import namedtuple
+
+import numpy as np
+from scipy.optimize import nnls
+
+from spectral_similarity import SimilarityMatch
+
+# number of library spectra, by overlap with the query, that the fit may choose from
+CANDIDATES = 200
+# largest number of components reported
+MAX_COMPONENTS = 10
+# components explaining less than this fraction of the fitted query are dropped
+MIN_CONTRIBUTION = 0.01
+# greedy fitting stops once a new component lowers the residual by less than this fraction of the query
+MIN_IMPROVEMENT = 0.01
+# a query peak counts as explained once the fit reproduces this fraction of its height
+EXPLAINED_FRACTION = 0.5
+
+Component = namedtuple('Component', ['weight', 'id', 'name'])
+
+
+class MixtureAnalysis:
+    """
+    Decomposes query spectra into components from the binned library of a loaded SimilarityMatch.
+    Library spectra are scaled to unit norm, so a component's weight is its share of the query in query units.
+    """
+    def __init__(self, similarity, candidates=CANDIDATES, max_components=MAX_COMPONENTS):
+        self.similarity = similarity
+        self.candidates = candidates
+        self.max_components = max_components
+
+    def prune(self, vector):
+        """
+        Keeps the library spectra with the largest overlap with the binned query, leaving out any without overlap.
+        Returns their indices in the library.
+        """
+        overlaps = np.asarray((self.similarity.matrix @ vector.T).todense()).ravel()
+        norms = np.where(self.similarity.norms > 0, self.similarity.norms, 1.0)
+        overlaps = overlaps / norms
+        spectra = np.flatnonzero(overlaps > 0)
+        if len(spectra) > self.candidates:
+            spectra = spectra[np.argpartition(-overlaps[spectra], self.candidates - 1)[:self.candidates]]
+        return spectra
+
+    def design(self, vector, spectra):
+        """
+        Builds the dense least squares problem over the bins where the query or a candidate has any intensity,
+        so candidate peaks missing from the query count against that candidate.
+        Returns the (bins, candidates) matrix, the query over the same bins and the bins used.
+        """
+        candidates = self.similarity.matrix[spectra]
+        norms = np.where(self.similarity.norms[spectra] > 0, self.similarity.norms[spectra], 1.0)
+        bins = np.union1d(candidates.indices, vector.indices)
+        matrix = (candidates[:, bins].toarray() / norms[:, None]).T
+        target = vector[:, bins].toarray().ravel()
+        return matrix, target, bins
+
+    def fit_nnls(self, matrix, target):
+        """
+        Fits the query with every candidate at once by non-negative least squares.
+        Returns the weight of each candidate.
+        """
+        weights, residual = nnls(matrix, target)
+        return weights
+
+    def fit_greedy(self, matrix, target):
+        """
+        Adds the candidate that best matches what is left of the query one at a time, refitting the weights of
+        the chosen candidates by non-negative least squares after each, until max_components are chosen or the
+        residual stops falling.
+        Returns the weight of each candidate, zero for those never chosen.
+        """
+        weights = np.zeros(matrix.shape[1])
+        chosen = []
+        residual = target
+        scale = np.linalg.norm(target)
+        while len(chosen) < min(self.max_components, matrix.shape[1]):
+            matches = matrix.T @ residual
+            matches[chosen] = 0.0
+            best = int(np.argmax(matches))
+            if matches[best] <= 0:
+                break
+            fitted, norm = nnls(matrix[:, chosen + [best]], target)
+            if np.linalg.norm(residual) - norm < MIN_IMPROVEMENT * scale:
+                break
+            chosen.append(best)
+            weights[:] = 0.0
+            weights[chosen] = fitted
+            residual = target - matrix[:, chosen] @ fitted
+        return weights
+
+    def analyse(self, shifts, intensities=None, widths=None, method='nnls'):
+        """
+        Identifies the library spectra that together explain the query peaks, by method 'nnls' or 'greedy'.
+        Returns the components, largest weight first, and the query shifts the components leave unexplained.
+        """
+        vector = self.similarity.query_matrix([(shifts, intensities, widths)]).tocsr()
+        spectra = self.prune(vector)
+        if len(spectra) == 0:
+            return [], list(shifts)
+        matrix, target, bins = self.design(vector, spectra)
+        if method == 'greedy':
+            weights = self.fit_greedy(matrix, target)
+        else:
+            weights = self.fit_nnls(matrix, target)
+
+        # keep the largest components that each explain a worthwhile share of the fit
+        contributions = weights * np.linalg.norm(matrix, axis=0)
+        kept = np.flatnonzero(contributions > MIN_CONTRIBUTION * max(contributions.sum(), 1e-12))
+        kept = kept[np.argsort(-weights[kept], kind='stable')][:self.max_components]
+        components = []
+        for position in kept:
+            id = self.similarity.keys[spectra[position]][0]
+            components.append(Component(float(weights[position]), id, self.similarity.names.get(id, '').strip(' "')))
+
+        # a query peak is unexplained when the fit falls well short of the query at the peak's bin
+        model = matrix[:, kept] @ weights[kept]
+        peak_bins = np.floor((np.asarray(shifts, dtype=float) - self.similarity.low) / self.similarity.resolution)
+        positions = np.clip(np.searchsorted(bins, peak_bins.astype(np.int64)), 0, len(bins) - 1)
+        explained = model[positions] >= EXPLAINED_FRACTION * target[positions]
+        unexplained = [shift for shift, found in zip(shifts, explained) if not found]
+        return components, unexplained
+
+
+def format_components(components, unexplained):
+    lines = [f"weight   id             molecule",
+             f"------   --             --------"]
+    for component in components:
+        lines.append("%-7.3f  %-10s     %-s" % (component.weight, component.id, component.name))
+    lines.append('')
+    lines.append(f"unexplained: {', '.join('%7.3f' % shift for shift in unexplained)}")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    similarity = SimilarityMatch()
+    similarity.load_databases()
+    mixture = MixtureAnalysis(similarity)
+    print(format_components(*mixture.analyse([float(arg) for arg in sys.argv[1:]])))
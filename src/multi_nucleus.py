@@ -0,0 +1,85 @@
+"""
+Matching against 1H and 13C spectra together.
+Each nucleus has its own match.Match library, loaded from the reader databases and compiled separately.
+A query gives target shifts per nucleus, each nucleus is scored against its own library and the scores are
+combined per metabolite, so a metabolite's 1H and 13C spectra both count towards its rank.
+"""
+
+import sys
+
+import numpy as np
+
+from match import Hit, Match, NUCLEI, format_hits, smallest
+
+# ppm distances of each nucleus are divided by its scale, 13C shifts spread about ten times as widely as 1H
+NUCLEUS_SCALES = {'1H': 1.0, '13C': 10.0}
+# scaled distance counted for each target of a nucleus the metabolite has no spectrum of
+MISSING_DISTANCE = 1.0
+
+
+class MultiNucleusMatch:
+    """
+    Holds a Match library per nucleus and ranks metabolites by their combined score over the nuclei queried.
+    The combined score is the sum over the nuclei of the metabolite's best spectrum score divided by the
+    nucleus scale.
+    """
+    def __init__(self, nuclei=NUCLEI, scales=NUCLEUS_SCALES, missing_distance=MISSING_DISTANCE):
+        self.nuclei = list(nuclei)
+        self.scales = dict(scales)
+        self.missing_distance = missing_distance
+        self.matches = {}
+
+    def load_databases(self, cwd='/home/mh491/Database'):
+        for nucleus in self.nuclei:
+            match = Match()
+            match.load_databases(cwd, nucleus)
+            self.matches[nucleus] = match
+
+    def metabolite_scores(self, nucleus, target_shifts):
+        """
+        Scores every spectrum of one nucleus against its targets and keeps each metabolite's best spectrum.
+        Returns the metabolite ids and their scaled scores.
+        """
+        match = self.matches[nucleus]
+        ids, owners = np.unique([key[0] for key in match.keys], return_inverse=True)
+        scores = np.full(len(ids), np.inf)
+        np.minimum.at(scores, owners, match.score(target_shifts))
+        return ids, scores / self.scales.get(nucleus, 1.0)
+
+    def top_k(self, shifts_by_nucleus, k=10):
+        """
+        Finds the k metabolites that best explain the target shifts of every nucleus, given as a dict such as
+        {'1H': [1.2, 3.4], '13C': [21.5, 70.1]}. A metabolite with no spectrum of a queried nucleus scores
+        missing_distance for each of that nucleus's targets.
+        Returns a list of Hit tuples, best first.
+        """
+        queried = {nucleus: targets for nucleus, targets in shifts_by_nucleus.items()
+                   if len(targets) > 0 and nucleus in self.matches}
+        scored = {nucleus: self.metabolite_scores(nucleus, targets) for nucleus, targets in queried.items()}
+        if not scored:
+            return []
+        ids = np.unique(np.concatenate([ids for ids, scores in scored.values()]))
+        combined = np.zeros(len(ids))
+        for nucleus, (nucleus_ids, scores) in scored.items():
+            missing = np.full(len(ids), self.missing_distance * len(queried[nucleus]))
+            missing[np.searchsorted(ids, nucleus_ids)] = scores
+            combined += missing
+        names = {}
+        for match in self.matches.values():
+            names.update(match.names)
+        hits = []
+        for score, position in smallest(combined, np.arange(len(ids)), k):
+            id = str(ids[position])
+            hits.append(Hit(score, id, names.get(id, '').strip(' "')))
+        return hits
+
+
+if __name__ == '__main__':
+    # shifts are given as 1H shifts, then -- and the 13C shifts
+    args = sys.argv[1:]
+    split = args.index('--') if '--' in args else len(args)
+    shifts = {'1H': [float(arg) for arg in args[:split]],
+              '13C': [float(arg) for arg in args[split + 1:]]}
+    match = MultiNucleusMatch()
+    match.load_databases()
+    print(format_hits(match.top_k(shifts)))
@@ -0,0 +1,127 @@
+"""
+Parallel matching over a process pool.
+The library arrays of a loaded match.Match are copied once into shared memory, every worker process maps them
+when it starts and scores its own shard of the spectra, so only the query and the shard bounds are sent per task.
+Each worker returns its local top k and the shard results are merged into the overall top k.
+"""
+
+import heapq
+import os
+import sys
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from match import Match, format_hits, smallest
+
+# the library arrays a worker needs to score spectra
+SHARED_ARRAYS = ['library', 'offsets', 'index']
+# shards per worker, a few more shards than workers evens out uneven spectra
+SHARDS_PER_WORKER = 4
+
+# the library of this worker process, set up by attach
+worker_match = None
+worker_blocks = []
+
+
+def attach(specs, index_base, index_span):
+    """
+    Pool initializer: maps the shared library arrays into a Match of this worker's own.
+    The blocks are unlinked by the parent process in ParallelMatch.close.
+    """
+    global worker_match
+    worker_match = Match()
+    for name, (block_name, shape, dtype) in specs.items():
+        block = SharedMemory(name=block_name)
+        worker_blocks.append(block)
+        setattr(worker_match, name, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+    worker_match.index_base = index_base
+    worker_match.index_span = index_span
+    worker_match.keys = range(len(worker_match.offsets) - 1)
+
+
+def shard_top_k(target_shifts, k, first, last):
+    """
+    Scores the spectra from first up to last against one query.
+    Returns the shard's top k as (score, spectrum) pairs.
+    """
+    spectra = np.arange(first, last)
+    return smallest(worker_match.score(target_shifts, spectra), spectra, k)
+
+
+def shard_top_k_batch(queries, k, first, last):
+    """
+    Scores the spectra from first up to last against a batch of queries.
+    Returns the shard's top k for each query as lists of (score, spectrum) pairs.
+    """
+    scores = worker_match.score_batch([np.asarray(query, dtype=float) for query in queries], first, last)
+    spectra = np.arange(first, last)
+    return [smallest(scores[:, column], spectra, k) for column in range(len(queries))]
+
+
+class ParallelMatch:
+    """
+    Splits exact matching against a loaded Match library over a pool of worker processes.
+    Call close when finished to stop the workers and free the shared memory.
+    """
+    def __init__(self, match, workers=None):
+        self.match = match
+        self.workers = workers or os.cpu_count()
+        self.blocks = []
+        specs = {}
+        for name in SHARED_ARRAYS:
+            array = np.ascontiguousarray(getattr(match, name))
+            block = SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self.blocks.append(block)
+            specs[name] = (block.name, array.shape, array.dtype.str)
+        spectra = len(match.keys)
+        count = max(1, min(spectra, self.workers * SHARDS_PER_WORKER))
+        bounds = np.linspace(0, spectra, count + 1).astype(np.int64).tolist()
+        self.shards = list(zip(bounds[:-1], bounds[1:]))
+        self.pool = Pool(self.workers, initializer=attach, initargs=(specs, match.index_base, match.index_span))
+
+    def top_k(self, target_shifts, k=10):
+        """
+        Scores every library spectrum against the target shifts, one shard per task.
+        Returns a list of Hit tuples, best first, the same as scoring the whole library in one process.
+        """
+        targets = [float(shift) for shift in target_shifts]
+        shards = self.pool.starmap(shard_top_k, [(targets, k, first, last) for first, last in self.shards])
+        return self.merge(shards, k)
+
+    def top_k_batch(self, target_shifts_sets, k=10):
+        """
+        Scores a batch of queries against every library spectrum, one shard per task.
+        A query with a target that is not a finite number is not scored and gets no hits, as in Match.top_k_batch.
+        Returns a list with the list of hits for each query, in the order given.
+        """
+        queries = [[float(shift) for shift in target_shifts] for target_shifts in target_shifts_sets]
+        valid = [bool(np.isfinite(query).all()) for query in queries]
+        queries = [query if ok else [] for query, ok in zip(queries, valid)]
+        shards = self.pool.starmap(shard_top_k_batch, [(queries, k, first, last) for first, last in self.shards])
+        return [self.merge([shard[query] for shard in shards], k) if valid[query] else []
+                for query in range(len(queries))]
+
+    def merge(self, shards, k):
+        best = heapq.nsmallest(k, heapq.merge(*shards))
+        return [self.match.hit(score, spectrum) for score, spectrum in best]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+if __name__ == '__main__':
+    match = Match()
+    match.load()
+    parallel = ParallelMatch(match)
+    try:
+        print(format_hits(parallel.top_k([float(arg) for arg in sys.argv[1:]])))
+    finally:
+        parallel.close()
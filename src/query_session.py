@@ -0,0 +1,95 @@
+"""
+Incremental matching for interactive assignment, where peaks are added to or removed from a query one at a time.
+A session keeps the distance from each of its target shifts to the nearest shift of every library spectrum,
+together with the running score of every spectrum, the sum of those distances.
+Adding a target only computes the distances for that one target and removing one subtracts its stored distances,
+so each change is a single pass over the library however many targets the query already has.
+"""
+
+import sys
+
+import numpy as np
+
+from match import Match, MAX_BLOCK_SIZE, format_hits
+
+
+class QuerySession:
+    """
+    A query against a loaded Match library that is refined one target shift at a time.
+    The scores are the same as Match.score over all the spectra for the current targets.
+    """
+    def __init__(self, match, target_shifts=()):
+        self.match = match
+        self.version = match.version
+        self.spectra = np.arange(len(match.keys))
+        self.targets = []
+        self.columns = []
+        self.scores = np.zeros(len(self.spectra))
+        for shift in target_shifts:
+            self.add_shift(shift)
+
+    def distances(self, shift):
+        """
+        Finds the distance from one target shift to the nearest shift of every spectrum in the library.
+        Returns an array in the order of self.match.keys.
+        """
+        column = np.empty(len(self.spectra))
+        for start in range(0, len(self.spectra), MAX_BLOCK_SIZE):
+            spectra = self.spectra[start:start + MAX_BLOCK_SIZE]
+            column[start:start + MAX_BLOCK_SIZE] = self.match.nearest([shift], spectra)[:, 0]
+        return column
+
+    def add_shift(self, shift):
+        self.check_library()
+        shift = float(shift)
+        column = self.distances(shift)
+        self.targets.append(shift)
+        self.columns.append(column)
+        self.scores += column
+
+    def remove_shift(self, shift):
+        """
+        Removes the target closest to the given shift, so a shift read back from a display need not be exact.
+        Returns the target removed, or None when the session has no targets.
+        """
+        self.check_library()
+        if not self.targets:
+            return None
+        target = int(np.argmin(np.abs(np.asarray(self.targets) - float(shift))))
+        column = self.columns.pop(target)
+        if self.columns:
+            self.scores -= column
+        else:
+            # start again from exact zeros rather than whatever rounding is left over
+            self.scores[:] = 0.0
+        return self.targets.pop(target)
+
+    def check_library(self):
+        """
+        Recomputes the stored distances if the library has been reloaded since they were computed.
+        """
+        if self.version == self.match.version:
+            return
+        self.version = self.match.version
+        self.spectra = np.arange(len(self.match.keys))
+        self.columns = [self.distances(shift) for shift in self.targets]
+        self.scores = np.sum(self.columns, axis=0) if self.columns else np.zeros(len(self.spectra))
+
+    def top_k(self, k=10):
+        """
+        Ranks the library by the running scores of the current targets.
+        Returns a list of Hit tuples, best first.
+        """
+        self.check_library()
+        return self.match.select(self.scores, self.spectra, k)
+
+
+if __name__ == '__main__':
+    match = Match()
+    match.load()
+    session = QuerySession(match)
+    for arg in sys.argv[1:]:
+        session.add_shift(arg)
+        print(f"targets: {', '.join('%7.3f' % shift for shift in session.targets)}")
+        print(format_hits(session.top_k()))
+        print()
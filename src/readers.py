@@ -6,6 +6,8 @@ import statistics
 import sqlite3
 from sqlite3 import Error
 
+import hmdb_xml
+
 class HMDB_Metabolite_Reader:
 
     def __init__(self, directory):
@@ -35,21 +37,12 @@ class HMDB_Metabolite_Reader:
     def run(self):
         file = pathlib.Path(self._directory, 'hmdb_metabolites.xml')
 
-        nsmap = {}
-
-        for i, (event, elem) in enumerate(et.iterparse(file, events=('end', 'start-ns'))):
-            if event == 'start-ns':
-                ns, url = elem
-                nsmap[ns] = url
-            elif event == 'end' and self.get_tag(elem) in ['metabolite']:
-                name = None
-                accession = None
-                for accession in elem.findall('{http://www.hmdb.ca}accession'):
-                    accession = accession.text
-                for name in elem.findall('{http://www.hmdb.ca}name'):
-                    name = name.text.replace(',', '-')
-                self.output(accession, name)
-                elem.clear()
+        for elem in hmdb_xml.iter_metabolites(file):
+            accession = elem.findtext('{http://www.hmdb.ca}accession')
+            name = elem.findtext('{http://www.hmdb.ca}name')
+            if name is not None:
+                name = name.replace(',', '-')
+            self.output(accession, name)
 
 
 class HMDB_Metabolites_to_CSV(HMDB_Metabolite_Reader):
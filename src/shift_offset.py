@@ -0,0 +1,166 @@
+"""
+Matching that allows for a global chemical shift referencing offset between the query and the library,
+as between spectra referenced to DSS and to TMS.
+The query and the candidate spectra are binned into peak vectors and cross-correlated with one FFT per spectrum,
+which scores every offset within max_offset at once. The query is then moved by the best offset and scored
+exactly with the nearest shift score of match.Match, next to its score without any offset.
+"""
+
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+from match import Match, MAX_BLOCK_SIZE, smallest
+
+# largest referencing offset searched for, in ppm either way
+MAX_OFFSET = 0.1
+# bin width in ppm of the peak vectors, the offsets found are multiples of it
+RESOLUTION = 0.001
+# standard deviation in ppm of the gaussian the query peaks are smeared with, so near misses still correlate
+SMOOTHING = 0.005
+# peaks further than this many standard deviations of the smoothing from a query peak are left out
+SMOOTHING_REACH = 4.0
+# number of spectra cross-correlated together
+FFT_BLOCK_SIZE = 256
+
+OffsetHit = namedtuple('OffsetHit', ['score', 'raw_score', 'offset', 'id', 'name'])
+
+
+class OffsetSearch:
+    """
+    Finds the best referencing offset of a query against each candidate spectrum, or one offset for the
+    whole library, and ranks the spectra by their score at that offset.
+    """
+    def __init__(self, match, max_offset=MAX_OFFSET, resolution=RESOLUTION, smoothing=SMOOTHING):
+        self.match = match
+        self.max_offset = max_offset
+        self.resolution = resolution
+        self.smoothing = smoothing
+
+    def windows(self, targets, reach):
+        """
+        Merges the ppm windows reaching either side of each target where they overlap.
+        Returns the sorted starts and ends of the merged windows.
+        """
+        targets = np.sort(targets)
+        breaks = np.flatnonzero(np.diff(targets) > 2 * reach) + 1
+        starts = targets[np.concatenate([[0], breaks])] - reach
+        ends = targets[np.concatenate([breaks - 1, [len(targets) - 1]])] + reach
+        return starts, ends
+
+    def correlate(self, target_shifts, spectra):
+        """
+        Cross-correlates the binned query with the binned peaks of each spectrum.
+        Returns the offsets searched, in ppm, and a (spectra, offsets) array of correlations where a larger
+        value means more query peaks land on the spectrum's peaks once moved by that offset.
+        """
+        targets = np.asarray(target_shifts, dtype=float)
+        lags = int(round(self.max_offset / self.resolution))
+        offsets = np.arange(-lags, lags + 1) * self.resolution
+        correlations = np.zeros((len(spectra), len(offsets)))
+        if len(targets) == 0 or len(spectra) == 0:
+            return offsets, correlations
+
+        # library peaks further than the largest offset and the smoothing from every query peak cannot add to the
+        # lags searched, so the bins only cover windows of that reach round the query peaks, laid end to end
+        reach = self.max_offset + SMOOTHING_REACH * self.smoothing
+        starts, ends = self.windows(targets, reach)
+        lengths = np.ceil((ends - starts) / self.resolution).astype(np.int64) + 1
+        bases = np.cumsum(lengths) - lengths
+        # the padding stops the circular correlation wrapping round into the lags searched
+        size = int(2 ** np.ceil(np.log2(lengths.sum() + lags + 1)))
+
+        def place(shifts):
+            window = np.maximum(np.searchsorted(starts, shifts, side='right') - 1, 0)
+            inside = (shifts >= starts[window]) & (shifts <= ends[window])
+            return inside, bases[window] + np.round((shifts - starts[window]) / self.resolution).astype(np.int64)
+
+        inside, bins = place(targets)
+        query = np.bincount(bins[inside], minlength=size)
+        frequencies = np.fft.rfftfreq(size, d=self.resolution)
+        smoothing = np.exp(-2.0 * (np.pi * frequencies * self.smoothing) ** 2)
+        query = np.conj(np.fft.rfft(query)) * smoothing
+
+        for start in range(0, len(spectra), FFT_BLOCK_SIZE):
+            block = spectra[start:start + FFT_BLOCK_SIZE]
+            counts = self.match.offsets[block + 1] - self.match.offsets[block]
+            rows = np.repeat(np.arange(len(block)), counts)
+            firsts = np.repeat(self.match.offsets[block] - (np.cumsum(counts) - counts), counts)
+            inside, bins = place(self.match.library[firsts + np.arange(len(rows))])
+            vectors = np.bincount(rows[inside] * size + bins[inside], minlength=len(block) * size)
+            correlation = np.fft.irfft(np.fft.rfft(vectors.reshape(len(block), size), axis=1) * query, n=size, axis=1)
+            # lag l sits at column l, negative lags wrap round to the end
+            correlations[start:start + len(block)] = np.concatenate([correlation[:, size - lags:],
+                                                                     correlation[:, :lags + 1]], axis=1)
+        return offsets, correlations
+
+    def best_offsets(self, target_shifts, spectra, per_library=False):
+        """
+        Picks the offset with the highest correlation for each spectrum, or with per_library the offset with the
+        highest correlation summed over all the spectra. Ties go to the smallest offset.
+        Returns an array with the offset of each spectrum.
+        """
+        offsets, correlations = self.correlate(target_shifts, spectra)
+        if per_library:
+            correlations = correlations.sum(axis=0, keepdims=True)
+        # prefer small offsets among near equal correlations
+        order = np.argsort(np.abs(offsets), kind='stable')
+        best = order[np.argmax(np.round(correlations[:, order], 9), axis=1)]
+        return np.broadcast_to(offsets[best], (len(spectra),)).copy()
+
+    def score(self, target_shifts, spectra, offsets):
+        """
+        Scores each spectrum against the target shifts moved by its own offset.
+        Returns an array of scores in the order of spectra.
+        """
+        targets = np.asarray(target_shifts, dtype=float)
+        scores = np.zeros(len(spectra))
+        if len(targets) == 0:
+            return scores
+        step = max(1, MAX_BLOCK_SIZE // len(targets))
+        for start in range(0, len(spectra), step):
+            shifted = targets[None, :] + offsets[start:start + step, None]
+            scores[start:start + step] = self.match.nearest(shifted, spectra[start:start + step]).sum(axis=1)
+        return scores
+
+    def top_k(self, target_shifts, k=10, per_library=False, **conditions):
+        """
+        Ranks the candidate spectra by their score at their best offset, never worse than the raw score as
+        an offset of zero is always searched. Candidates are found with a bin tolerance widened by max_offset,
+        see Match.candidates, and may be limited to the spectra recorded under the given conditions.
+        Returns a list of OffsetHit tuples, best first, each with the raw score and the offset used.
+        """
+        targets = np.asarray(target_shifts, dtype=float)
+        spectra = self.match.candidates(targets, tolerance=self.max_offset + self.match.bin_width,
+                                        spectra=self.match.spectra_where(**conditions))
+        raw_scores = self.match.score(targets, spectra)
+        offsets = self.best_offsets(targets, spectra, per_library)
+        scores = self.score(targets, spectra, offsets)
+        # binning can put the correlation peak a little off, the raw score stands when it is better
+        worse = scores > raw_scores
+        scores[worse] = raw_scores[worse]
+        offsets[worse] = 0.0
+        hits = []
+        for score, position in smallest(scores, np.arange(len(spectra)), k):
+            hit = self.match.hit(score, spectra[position])
+            hits.append(OffsetHit(score, float(raw_scores[position]), float(offsets[position]), hit.id, hit.name))
+        return hits
+
+
+def format_offset_hits(hits):
+    """
+    Formats a list of hits from OffsetSearch.top_k like format_hits, with the raw score and offset of each.
+    """
+    lines = [f"score    raw      offset   id             molecule",
+             f"-----    ---      ------   --             --------"]
+    for hit in hits:
+        lines.append("%-7.3f  %-7.3f  %+6.3f   %-10s     %-s" % (hit.score, hit.raw_score, hit.offset, hit.id, hit.name))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    match = Match()
+    match.load()
+    search = OffsetSearch(match)
+    print(format_offset_hits(search.top_k([float(arg) for arg in sys.argv[1:]])))
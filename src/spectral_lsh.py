@@ -0,0 +1,222 @@
+"""
+Approximate candidate search for very large libraries using MinHash signatures and locality sensitive hashing.
+Each library spectrum becomes the set of ppm tokens its peaks fall in, widened by one token either side for the
+tolerance, and is summarised by a MinHash signature that is split into bands and hashed into buckets.
+A query only looks up its own buckets, and the candidates that come back are re-scored exactly with match.Match.
+"""
+
+import hashlib
+import json
+import pathlib
+import sys
+
+import numpy as np
+
+from match import Match, COMPILED_DIRECTORY, compile_lock, format_hits, new_generation, publish
+
+# width of a ppm token, peaks within about this distance of each other share a token
+TOLERANCE = 0.02
+# the signature is bands x rows hashes long, more bands raise recall and fewer rows raise it further,
+# both at the cost of more candidates to re-score
+BANDS = 32
+ROWS = 2
+# the prime the hash functions work modulo, small enough that products fit in 64 bits
+PRIME = (1 << 31) - 1
+# number of hash functions evaluated together while building signatures
+HASH_BLOCK_SIZE = 16
+# most tokens hashed together while building signatures, whole spectra are taken until the next one would not fit,
+# which bounds the memory of a build to about TOKEN_BLOCK_SIZE * HASH_BLOCK_SIZE * 8 bytes
+TOKEN_BLOCK_SIZE = 1 << 20
+# prefix of the generation directories a saved index is written to, see match.new_generation
+LSH_GENERATION = 'lsh_index_'
+# the arrays of a saved index
+LSH_ARRAYS = ['signatures', 'bucket_keys', 'bucket_spectra']
+
+
+def token_blocks(offsets, size=TOKEN_BLOCK_SIZE):
+    """
+    Splits the sets delimited by offsets into consecutive blocks of whole sets holding at most size tokens each,
+    a set larger than size being a block of its own.
+    Returns a list of (first, last) set ranges.
+    """
+    blocks = []
+    first = 0
+    sets = len(offsets) - 1
+    while first < sets:
+        last = int(np.searchsorted(offsets, offsets[first] + size, side='right')) - 1
+        last = min(max(last, first + 1), sets)
+        blocks.append((first, last))
+        first = last
+    return blocks
+
+
+class LSHIndex:
+    """
+    A MinHash/LSH index over the spectra of a loaded Match library.
+    """
+    def __init__(self, match, tolerance=TOLERANCE, bands=BANDS, rows=ROWS, seed=1):
+        self.match = match
+        self.tolerance = tolerance
+        self.bands = bands
+        self.rows = rows
+        self.seed = seed
+        random = np.random.default_rng(seed)
+        self.a = random.integers(1, PRIME, size=bands * rows, dtype=np.uint64)
+        self.b = random.integers(0, PRIME, size=bands * rows, dtype=np.uint64)
+        self.band_mixers = random.integers(1, 1 << 63, size=rows, dtype=np.uint64) | np.uint64(1)
+        # signatures of the library spectra and, per band, the bucket keys in sorted order with their spectra
+        self.signatures = np.empty((0, bands * rows), dtype=np.uint64)
+        self.bucket_keys = np.empty((bands, 0), dtype=np.uint64)
+        self.bucket_spectra = np.empty((bands, 0), dtype=np.int64)
+
+    def tokens(self, shifts):
+        """
+        Turns shifts into tolerance widened tokens, each shift gives its own token and its two neighbours.
+        Returns the tokens, repeated three times in the order of the shifts, as non-negative integers.
+        """
+        tokens = np.floor(np.asarray(shifts, dtype=float) / self.tolerance).astype(np.int64)
+        widened = tokens[:, None] + np.array([-1, 0, 1], dtype=np.int64)
+        return (widened.ravel() % PRIME).astype(np.uint64)
+
+    def minhash(self, tokens, offsets):
+        """
+        Computes the MinHash signature of each token set, set i being tokens[offsets[i]:offsets[i + 1]].
+        Returns a (sets, bands * rows) array.
+        """
+        offsets = np.asarray(offsets, dtype=np.int64)
+        signatures = np.empty((len(offsets) - 1, len(self.a)), dtype=np.uint64)
+        for first, last in token_blocks(offsets):
+            block = tokens[offsets[first]:offsets[last]]
+            starts = offsets[first:last] - offsets[first]
+            empty = offsets[first + 1:last + 1] == offsets[first:last]
+            if len(block) == 0:
+                signatures[first:last] = PRIME
+                continue
+            starts = np.minimum(starts, len(block) - 1)
+            for start in range(0, len(self.a), HASH_BLOCK_SIZE):
+                stop = start + HASH_BLOCK_SIZE
+                hashes = (block[:, None] * self.a[None, start:stop] + self.b[None, start:stop]) % np.uint64(PRIME)
+                signatures[first:last, start:stop] = np.minimum.reduceat(hashes, starts, axis=0)
+            signatures[first:last][empty] = PRIME
+        return signatures
+
+    def band_keys(self, signatures):
+        """
+        Hashes the rows of each band of the signatures into a single bucket key.
+        Returns a (bands, sets) array of keys.
+        """
+        bands = signatures.reshape(len(signatures), self.bands, self.rows)
+        return (bands * self.band_mixers).sum(axis=2).T
+
+    def build(self):
+        """
+        Builds the signatures and buckets for every spectrum in the library.
+        """
+        offsets = self.match.offsets
+        self.signatures = np.empty((len(offsets) - 1, len(self.a)), dtype=np.uint64)
+        # the tokens are made a block of spectra at a time so they never exist for the whole library at once
+        for first, last in token_blocks(offsets * 3):
+            tokens = self.tokens(self.match.library[offsets[first]:offsets[last]])
+            self.signatures[first:last] = self.minhash(tokens, (offsets[first:last + 1] - offsets[first]) * 3)
+        keys = self.band_keys(self.signatures)
+        self.bucket_spectra = np.argsort(keys, axis=1, kind='stable')
+        self.bucket_keys = np.take_along_axis(keys, self.bucket_spectra, axis=1)
+
+    def fingerprint(self):
+        """
+        Identifies the library and parameters an index was built for.
+        """
+        library = np.ascontiguousarray(self.match.library)
+        return {'library': hashlib.sha1(library.tobytes()).hexdigest(),
+                'spectra': len(self.match.keys),
+                'tolerance': self.tolerance,
+                'bands': self.bands,
+                'rows': self.rows,
+                'seed': self.seed}
+
+    def save(self, directory):
+        """
+        Saves the signatures and buckets next to the library, in the given directory.
+        Like a compiled library the index goes in a new generation directory that the manifest is then switched
+        to, so an index another process has mapped is never written over.
+        """
+        directory = pathlib.Path(directory)
+        generation = new_generation(directory, LSH_GENERATION)
+        for name in LSH_ARRAYS:
+            np.save(generation.joinpath(f'{name}.npy'), getattr(self, name))
+        publish(directory, 'lsh_manifest.json', dict(self.fingerprint(), generation=generation.name), LSH_GENERATION)
+        # indexes saved before generations were used kept their arrays in the directory itself
+        for path in directory.glob('lsh_*.npy'):
+            path.unlink()
+
+    def load(self, directory):
+        """
+        Loads saved signatures and buckets if they were built for this library with these parameters.
+        Returns True on success.
+        """
+        directory = pathlib.Path(directory)
+        try:
+            with open(directory.joinpath('lsh_manifest.json'), 'r') as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return False
+        generation = manifest.pop('generation', None)
+        if generation is None or manifest != self.fingerprint():
+            return False
+        generation = directory.joinpath(generation)
+        try:
+            for name in LSH_ARRAYS:
+                setattr(self, name, np.load(generation.joinpath(f'{name}.npy'), mmap_mode='r'))
+        except (OSError, ValueError) as e:
+            print(e)
+            return False
+        return True
+
+    def load_or_build(self, directory):
+        """
+        Loads the saved index or builds and saves it, holding a lock while building so processes take turns.
+        """
+        if self.load(directory):
+            return
+        with compile_lock(pathlib.Path(directory), 'lsh.lock'):
+            if not self.load(directory):
+                self.build()
+                self.save(directory)
+
+    def candidates(self, target_shifts):
+        """
+        Looks up the buckets of the target shifts in every band.
+        Returns the spectra that share at least one bucket with the query.
+        """
+        if len(target_shifts) == 0:
+            return np.empty(0, dtype=np.int64)
+        tokens = self.tokens(target_shifts)
+        keys = self.band_keys(self.minhash(tokens, np.array([0, len(tokens)])))[:, 0]
+        found = []
+        for band, key in enumerate(keys):
+            low = np.searchsorted(self.bucket_keys[band], key, side='left')
+            high = np.searchsorted(self.bucket_keys[band], key, side='right')
+            found.append(self.bucket_spectra[band, low:high])
+        return np.unique(np.concatenate(found))
+
+    def top_k(self, target_shifts, k=10, min_candidates=None):
+        """
+        Re-scores the LSH candidates exactly with the nearest shift score of the library.
+        Falls back to Match.top_k when fewer than min_candidates (by default k) candidates are found.
+        Returns a list of Hit tuples, best first.
+        """
+        if min_candidates is None:
+            min_candidates = k
+        spectra = self.candidates(target_shifts)
+        if len(spectra) < min_candidates:
+            return self.match.top_k(target_shifts, k)
+        return self.match.select(self.match.score(target_shifts, spectra), spectra, k)
+
+
+if __name__ == '__main__':
+    cwd = '/home/mh491/Metameta_Files'
+    match = Match()
+    match.load(cwd)
+    index = LSHIndex(match)
+    index.load_or_build(pathlib.Path(cwd, COMPILED_DIRECTORY))
+    print(format_hits(index.top_k([float(arg) for arg in sys.argv[1:]])))
@@ -0,0 +1,171 @@
+"""
+A second matching engine that ranks library spectra by full spectrum similarity instead of peak positions alone.
+Every peak (shift, intensity, width) from the readers' peaks tables is drawn as a Lorentzian line over fixed width
+ppm bins, and the whole library is kept as one sparse spectra x bins matrix.
+Scoring a query, or a batch of queries, against the library is then a single sparse matrix product.
+"""
+
+import pathlib
+import heapq
+import sys
+
+import numpy as np
+from scipy import sparse
+
+from match import Hit, SOURCE_DATABASES, format_hits, stream_peaks
+
+# bin width in ppm and the ppm range covered by the binned spectra
+RESOLUTION = 0.005
+PPM_RANGE = (-1.0, 13.0)
+# half width in ppm used for peaks without one, matching the readers' default
+DEFAULT_WIDTH = 0.004
+# lines are drawn out to this many half widths either side of the peak
+LINE_REACH = 3.0
+
+
+class SimilarityMatch:
+    """
+    Holds the binned library and scores queries by cosine similarity (or plain dot product) with it.
+    Higher scores are better, unlike the nearest shift score of match.Match.
+    """
+    def __init__(self, resolution=RESOLUTION, ppm_range=PPM_RANGE):
+        self.resolution = resolution
+        self.low = ppm_range[0]
+        self.n_bins = int(np.ceil((ppm_range[1] - ppm_range[0]) / resolution))
+        self.keys = []
+        self.names = {}
+        self.matrix = sparse.csr_matrix((0, self.n_bins))
+        self.norms = np.empty(0)
+
+    def load_database(self, path, peaks=None):
+        """
+        Gathers the peaks of every spectrum in a database built by the readers.
+        Returns the (owners, shifts, intensities, widths) lists, extended in place when given.
+        """
+        if peaks is None:
+            peaks = ([], [], [], [])
+        owners, shifts, intensities, widths = peaks
+        rows = {key: row for row, key in enumerate(self.keys)}
+        columns = ['cast(peaks.intensity as real)', 'cast(peaks.width as real)']
+        for id, spectrum_id, name, shift, intensity, width in stream_peaks(path, columns):
+            key = (id, spectrum_id)
+            if key not in rows:
+                rows[key] = len(self.keys)
+                self.keys.append(key)
+                self.names[id] = name
+            owners.append(rows[key])
+            shifts.append(shift)
+            intensities.append(intensity)
+            widths.append(width)
+        return peaks
+
+    def load_databases(self, cwd='/home/mh491/Database'):
+        """
+        Loads the hmdb and bmrb databases and bins them into the library matrix.
+        """
+        peaks = None
+        for database in SOURCE_DATABASES:
+            peaks = self.load_database(pathlib.Path(cwd, database), peaks)
+        self.build(*peaks)
+
+    def build(self, owners, shifts, intensities, widths):
+        """
+        Bins the library peaks into the sparse library matrix, one row per spectrum in self.keys.
+        """
+        self.matrix = self.vectorize(owners, shifts, intensities, widths, len(self.keys))
+        self.norms = np.sqrt(np.asarray(self.matrix.multiply(self.matrix).sum(axis=1)).ravel())
+
+    def vectorize(self, owners, shifts, intensities, widths, rows):
+        """
+        Draws each peak as a Lorentzian line of the given intensity and half width over the ppm bins.
+        Missing intensities count as 1 and missing widths as DEFAULT_WIDTH.
+        Returns a (rows, bins) sparse matrix with the lines of each owner summed into its row.
+        """
+        owners = np.asarray(owners, dtype=np.int64)
+        shifts = np.asarray(shifts, dtype=float)
+        intensities = np.nan_to_num(np.asarray(intensities, dtype=float), nan=1.0)
+        widths = np.asarray(widths, dtype=float)
+        widths = np.where(np.isfinite(widths) & (widths > 0), widths, DEFAULT_WIDTH)
+
+        reach = LINE_REACH * np.maximum(widths, self.resolution)
+        lows = np.clip(np.floor((shifts - reach - self.low) / self.resolution), 0, self.n_bins).astype(np.int64)
+        highs = np.clip(np.floor((shifts + reach - self.low) / self.resolution) + 1, 0, self.n_bins).astype(np.int64)
+        counts = np.maximum(highs - lows, 0)
+
+        # one entry per (peak, bin) pair covered by the peak's line
+        peaks = np.repeat(np.arange(len(shifts)), counts)
+        firsts = np.repeat(np.cumsum(counts) - counts, counts)
+        bins = lows[peaks] + np.arange(len(peaks)) - firsts
+        centres = self.low + (bins + 0.5) * self.resolution
+        squared = widths[peaks] ** 2
+        values = intensities[peaks] * squared / ((centres - shifts[peaks]) ** 2 + squared)
+        matrix = sparse.coo_matrix((values, (owners[peaks], bins)), shape=(rows, self.n_bins))
+        return matrix.tocsr()
+
+    def query_matrix(self, queries):
+        """
+        Bins a list of queries, each a list of shifts or a (shifts, intensities, widths) tuple in which the
+        intensities and widths may be None.
+        Returns a (queries, bins) sparse matrix.
+        """
+        owners, shifts, intensities, widths = [], [], [], []
+        for row, query in enumerate(queries):
+            if isinstance(query, tuple):
+                query_shifts, query_intensities, query_widths = query
+            else:
+                query_shifts, query_intensities, query_widths = query, None, None
+            count = len(query_shifts)
+            owners.extend([row] * count)
+            shifts.extend(query_shifts)
+            intensities.extend(query_intensities if query_intensities is not None else [1.0] * count)
+            widths.extend(query_widths if query_widths is not None else [DEFAULT_WIDTH] * count)
+        return self.vectorize(owners, shifts, intensities, widths, len(queries))
+
+    def score_batch(self, queries, metric='cosine'):
+        """
+        Scores every library spectrum against a batch of queries with one sparse matrix product.
+        Returns a (spectra, queries) array of cosine similarities, or dot products with metric='dot'.
+        """
+        vectors = self.query_matrix(queries)
+        scores = np.asarray((self.matrix @ vectors.T).todense())
+        if metric == 'cosine':
+            query_norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+            denominators = np.outer(self.norms, query_norms)
+            scores = np.divide(scores, denominators, out=np.zeros_like(scores), where=denominators > 0)
+        return scores
+
+    def top_k(self, shifts, intensities=None, widths=None, k=10, metric='cosine'):
+        """
+        Finds the k library spectra most similar to the query peaks.
+        Returns a list of Hit tuples, best first.
+        """
+        return self.top_k_batch([(shifts, intensities, widths)], k, metric)[0]
+
+    def top_k_batch(self, queries, k=10, metric='cosine'):
+        """
+        Finds the k most similar library spectra for each of a batch of queries.
+        Returns a list with the list of hits for each query, in the order given.
+        """
+        scores = self.score_batch(queries, metric)
+        return [self.select(scores[:, column], k) for column in range(len(queries))]
+
+    def select(self, scores, k):
+        """
+        Picks the k highest scores with a bounded heap, breaking ties by library order.
+        """
+        spectra = np.arange(len(scores))
+        if 0 < k < len(scores):
+            kept = scores >= np.partition(scores, len(scores) - k)[len(scores) - k]
+            scores, spectra = scores[kept], spectra[kept]
+        best = heapq.nsmallest(k, zip((-scores).tolist(), spectra.tolist()))
+        return [self.hit(-score, spectrum) for score, spectrum in best]
+
+    def hit(self, score, spectrum):
+        id = self.keys[spectrum][0]
+        return Hit(score, id, self.names.get(id, '').strip(' "'))
+
+
+if __name__ == '__main__':
+    similarity = SimilarityMatch()
+    similarity.load_databases()
+    print(format_hits(similarity.top_k([float(arg) for arg in sys.argv[1:]])))